@@ -5,24 +5,70 @@ CREATE TABLE IF NOT EXISTS analytics.events_fact
     event_id String,
     user_id String,
     event_type String,
-    timestamp DateTime
+    timestamp DateTime,
+    -- Server time of the insert; splits rows between a new materialized
+    -- view and its backfill
+    inserted_at DateTime DEFAULT now()
 )
 ENGINE = MergeTree
 PARTITION BY toDate(timestamp)
-ORDER BY (event_type, timestamp);
+ORDER BY (event_type, timestamp)
+SETTINGS non_replicated_deduplication_window = 10000;
+
+-- Existing installs: pin the rows written before the column existed, which
+-- would otherwise read as inserted right now
+ALTER TABLE analytics.events_fact
+    ADD COLUMN IF NOT EXISTS inserted_at DateTime DEFAULT now();
+
+ALTER TABLE analytics.events_fact
+    MATERIALIZE COLUMN inserted_at
+SETTINGS mutations_sync = 1;
+
+-- Existing installs: plain MergeTree only honours insert_deduplication_token
+-- with a non-zero deduplication window.
+ALTER TABLE analytics.events_fact
+    MODIFY SETTING non_replicated_deduplication_window = 10000;
 
 CREATE TABLE IF NOT EXISTS analytics.events_agg
 (
     rule_id String,
     window_start DateTime,
     metric String,
+    -- components joined by '\x1f'; '__all__' where ROLLUP/CUBE dropped one
     group_key String,
-    value UInt64
+    group_values Array(String),
+    value UInt64,
+    -- distinct-user states, merged by rollups and range queries:
+    -- exact for active_users, HyperLogLog for active_users_approx
+    users_state AggregateFunction(uniqExact, String),
+    users_sketch AggregateFunction(uniqCombined64, String)
 )
 ENGINE = ReplacingMergeTree()
 PARTITION BY toDate(window_start)
 ORDER BY (rule_id, window_start, metric, group_key);
 
+ALTER TABLE analytics.events_agg
+    ADD COLUMN IF NOT EXISTS group_values Array(String),
+    ADD COLUMN IF NOT EXISTS users_state AggregateFunction(uniqExact, String),
+    ADD COLUMN IF NOT EXISTS users_sketch AggregateFunction(uniqCombined64, String);
+
+-- Rules with top_n: one row per window holding only the heaviest group keys.
+-- `other` is the event_count of every key outside the top N.
+-- A recomputed window replaces the whole row.
+CREATE TABLE IF NOT EXISTS analytics.events_topn
+(
+    rule_id String,
+    window_start DateTime,
+    metric String,
+    top_keys Array(String),
+    top_values Array(UInt64),
+    other UInt64,
+    computed_at DateTime DEFAULT now()
+)
+ENGINE = ReplacingMergeTree(computed_at)
+PARTITION BY toDate(window_start)
+ORDER BY (rule_id, window_start, metric);
+
 CREATE TABLE IF NOT EXISTS analytics.aggregation_state
 (
     rule_id String,
@@ -30,3 +76,71 @@ CREATE TABLE IF NOT EXISTS analytics.aggregation_state
 )
 ENGINE = ReplacingMergeTree()
 ORDER BY rule_id;
+
+-- Target of the per-rule materialized views (AGGREGATION_MODE=materialized).
+-- event_count rules fill `value`, active_users rules fill `users`,
+-- active_users_approx rules fill `users_sketch`.
+CREATE TABLE IF NOT EXISTS analytics.events_agg_state
+(
+    rule_id String,
+    window_start DateTime,
+    metric String,
+    group_key String,
+    group_values SimpleAggregateFunction(any, Array(String)),
+    value SimpleAggregateFunction(sum, UInt64),
+    users AggregateFunction(uniqExact, String),
+    users_sketch AggregateFunction(uniqCombined64, String)
+)
+ENGINE = AggregatingMergeTree()
+PARTITION BY toDate(window_start)
+ORDER BY (rule_id, window_start, metric, group_key)
+SETTINGS non_replicated_deduplication_window = 10000;
+
+ALTER TABLE analytics.events_agg_state
+    ADD COLUMN IF NOT EXISTS group_values SimpleAggregateFunction(any, Array(String)),
+    ADD COLUMN IF NOT EXISTS users_sketch AggregateFunction(uniqCombined64, String);
+
+ALTER TABLE analytics.events_agg_state
+    MODIFY SETTING non_replicated_deduplication_window = 10000;
+
+-- AGGREGATION_MODE=streaming: the event-processor inserts each batch's
+-- partial aggregates here, one row per key: event_count keys carry `value`,
+-- distinct-user keys the batch's distinct `user_ids`. Nothing is stored,
+-- the view folds every insert into events_agg_state.
+CREATE TABLE IF NOT EXISTS analytics.events_agg_partial
+(
+    rule_id String,
+    window_start DateTime,
+    metric String,
+    group_key String,
+    group_values Array(String),
+    value UInt64,
+    user_ids Array(String)
+)
+ENGINE = Null;
+
+ALTER TABLE analytics.events_agg_partial
+    ADD COLUMN IF NOT EXISTS user_ids Array(String);
+
+-- Holds no data, so it is simply recreated with the current definition
+DROP VIEW IF EXISTS analytics.events_agg_partial_mv;
+
+CREATE MATERIALIZED VIEW analytics.events_agg_partial_mv
+TO analytics.events_agg_state
+AS
+SELECT
+    rule_id,
+    window_start,
+    metric,
+    group_key,
+    any(group_values)                                                AS group_values,
+    sum(value)                                                       AS value,
+    uniqExactStateIf(user_id, metric = 'active_users')               AS users,
+    uniqCombined64StateIf(user_id, metric = 'active_users_approx')   AS users_sketch
+FROM analytics.events_agg_partial
+LEFT ARRAY JOIN user_ids AS user_id
+GROUP BY
+    rule_id,
+    window_start,
+    metric,
+    group_key;
@@ -19,3 +19,13 @@ kafka-topics \
 
 echo "🚀 Topic events_raw created (12 partitions, RF=3)"
 
+
+kafka-topics \
+  --bootstrap-server kafka-1:9092 \
+  --create \
+  --if-not-exists \
+  --topic events_raw.dlq \
+  --partitions 3 \
+  --replication-factor 3
+
+echo "🚀 Topic events_raw.dlq created (3 partitions, RF=3)"
@@ -14,6 +14,18 @@ db.aggregation_rules.createIndex({ is_active: 1 });
 db.aggregation_rules.createIndex({ window_size: 1 });
 db.aggregation_rules.createIndex({ metric: 1 });
 
+// Rule registries poll on updated_at when change streams are unavailable
+db.aggregation_rules.createIndex({ updated_at: 1 });
+
+// Late-event backfill jobs, drained oldest window first per rule
+db.aggregation_backfill.createIndex({ rule_id: 1, window_start: 1 });
+
+// Replicas that stopped heartbeating drop out of the shard ring
+db.aggregation_members.createIndex(
+  { expires_at: 1 },
+  { expireAfterSeconds: 3600 }
+);
+
 db.aggregation_locks.createIndex(
   { expires_at: 1 },
   { expireAfterSeconds: 0 }
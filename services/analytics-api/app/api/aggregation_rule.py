@@ -63,3 +63,27 @@ async def create_rule(payload: AggregationRuleCreate):
         "db": mongo_db.name,
         "host": socket.gethostname(),
     }
+
+
+@router.delete(
+    "/{rule_id}",
+    response_model=dict,
+    summary="Deactivate aggregation rule",
+)
+async def deactivate_rule(rule_id: str):
+    collection = mongo_db.aggregation_rules
+
+    result = await collection.update_one(
+        {"rule_id": rule_id},
+        {"$set": {"is_active": False, "updated_at": datetime.utcnow()}},
+    )
+    if not result.matched_count:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Rule not found",
+        )
+
+    return {
+        "status": "deactivated",
+        "rule_id": rule_id,
+    }
@@ -1,12 +1,35 @@
 from datetime import datetime
 from fastapi import APIRouter, Query, HTTPException
-from typing import Optional
+from typing import List, Optional
 from app.schemas.schemas import StatsResponse
+from app.registry import rule_registry
 from app.clickhouse import clickhouse_client
+from app.core.config import STATE_MODES, settings
 from datetime import timezone
 
 router = APIRouter(prefix="/stats", tags=["Stats"])
 
+
+def _group_filters(rule_id: str, group: list[str]) -> list[tuple[int, str]]:
+    """Resolve ``column:value`` filters to 1-based group_values positions."""
+    rule = rule_registry.get(rule_id)
+    if not rule:
+        raise HTTPException(404, "Rule not found")
+
+    filters = []
+    for item in group:
+        column, sep, value = item.partition(":")
+        if not sep:
+            raise HTTPException(400, f"group filter must be column:value, got {item!r}")
+        try:
+            filters.append((rule["group_by"].index(column) + 1, value))
+        except ValueError:
+            raise HTTPException(
+                400, f"Rule {rule_id} does not group by {column}"
+            ) from None
+    return filters
+
+
 @router.get(
     "",
     summary="Get aggregated statistics",
@@ -23,6 +46,13 @@ async def get_stats(
     start_time: datetime = Query(..., description="Start time (ISO 8601)"),
     end_time: datetime = Query(..., description="End time (ISO 8601)"),
     event_type: Optional[str] = Query(None, description="Optional event_type filter"),
+    group: List[str] = Query(
+        [],
+        description=(
+            "Filter on one group_by column as column:value, repeatable; "
+            "use __all__ for ROLLUP/CUBE totals"
+        ),
+    ),
     limit: int = Query(100, ge=1, le=1000),
 ):
 
@@ -34,18 +64,11 @@ async def get_stats(
     if start_time >= end_time:
         raise HTTPException(400, "start_time must be < end_time")
 
-    query = """
-    SELECT
-        window_start,
-        group_key,
-        anyLast(value) AS value
-    FROM analytics.events_agg
-    PREWHERE
-        rule_id = %(rule_id)s
-        AND metric = 'event_count'
-        AND window_start >= %(start)s
-        AND window_start < %(end)s
-    """
+    if settings.AGGREGATION_MODE in STATE_MODES:
+        # Partial aggregates from the views or the consumer, merged on read
+        value_sql, table = "sum(value)", "analytics.events_agg_state"
+    else:
+        value_sql, table = "anyLast(value)", "analytics.events_agg"
 
     params = {
         "rule_id": rule_id,
@@ -54,16 +77,62 @@ async def get_stats(
         "limit": limit,
     }
 
+    key_filter = ""
+    topn_filter = ""
     if event_type:
-        query += " AND group_key = %(group_key)s"
+        key_filter = "AND group_key = %(group_key)s"
+        topn_filter = key_filter
         params["group_key"] = event_type
 
-    query += """
-    GROUP BY
-        window_start,
-        group_key
+    # Top-N rows keep only the joined key, so components are split back out
+    filters = _group_filters(rule_id, group) if group else []
+    for i, (idx, value) in enumerate(filters):
+        params[f"group_{i}"] = value
+        key_filter += f" AND group_values[{idx}] = %(group_{i})s"
+        topn_filter += f" AND splitByChar('\\x1f', group_key)[{idx}] = %(group_{i})s"
+
+    # Rules with top_n are stored one row per window in events_topn; the
+    # other branch is empty for them (and vice versa), both are primary-key
+    # lookups on rule_id.
+    query = f"""
+    SELECT window_start, group_key, value
+    FROM
+    (
+        SELECT
+            window_start,
+            group_key,
+            {value_sql} AS value
+        FROM {table}
+        PREWHERE
+            rule_id = %(rule_id)s
+            AND metric = 'event_count'
+            AND window_start >= %(start)s
+            AND window_start < %(end)s
+        WHERE 1 {key_filter}
+        GROUP BY
+            window_start,
+            group_key
+
+        UNION ALL
+
+        SELECT
+            window_start,
+            group_key,
+            value
+        FROM analytics.events_topn FINAL
+        ARRAY JOIN
+            arrayPushBack(top_keys, '__other__') AS group_key,
+            arrayPushBack(top_values, other)     AS value
+        WHERE
+            rule_id = %(rule_id)s
+            AND metric = 'event_count'
+            AND window_start >= %(start)s
+            AND window_start < %(end)s
+            {topn_filter}
+    )
     ORDER BY
-        window_start DESC
+        window_start DESC,
+        value DESC
     LIMIT %(limit)s
     """
 
@@ -82,4 +151,77 @@ async def get_stats(
             }
             for r in rows
         ],
-    }
\ No newline at end of file
+    }
+
+
+# uniqCombined64 switches to a HyperLogLog with 2^17 cells for large sets
+SKETCH_RELATIVE_ERROR = 1.04 / (2 ** 17) ** 0.5
+
+
+@router.get(
+    "/active-users",
+    summary="Distinct users over an arbitrary range",
+    description=(
+        "Merges the per-window HyperLogLog sketches of an "
+        "`active_users_approx` rule, so users active in several windows are "
+        "counted once. Small cardinalities are exact; larger ones carry the "
+        "reported relative standard error."
+    ),
+)
+async def get_active_users(
+    rule_id: str = Query(..., description="Aggregation rule ID"),
+    start_time: datetime = Query(..., description="Start time (ISO 8601)"),
+    end_time: datetime = Query(..., description="End time (ISO 8601)"),
+    group_key: Optional[str] = Query(None, description="Optional group key filter"),
+):
+    if start_time.tzinfo is None:
+        start_time = start_time.replace(tzinfo=timezone.utc)
+    if end_time.tzinfo is None:
+        end_time = end_time.replace(tzinfo=timezone.utc)
+
+    if start_time >= end_time:
+        raise HTTPException(400, "start_time must be < end_time")
+
+    table = (
+        "analytics.events_agg_state"
+        if settings.AGGREGATION_MODE in STATE_MODES
+        else "analytics.events_agg"
+    )
+
+    # Merging a sketch with a copy of itself is a no-op, so unmerged
+    # ReplacingMergeTree duplicates need no FINAL here.
+    query = f"""
+    SELECT uniqCombined64Merge(users_sketch)
+    FROM {table}
+    PREWHERE
+        rule_id = %(rule_id)s
+        AND metric = 'active_users_approx'
+        AND window_start >= %(start)s
+        AND window_start < %(end)s
+    """
+
+    params = {
+        "rule_id": rule_id,
+        "start": start_time,
+        "end": end_time,
+    }
+
+    if group_key:
+        query += " AND group_key = %(group_key)s"
+        params["group_key"] = group_key
+
+    rows = await clickhouse_client.query(query, params)
+    value = rows[0][0] if rows else 0
+    margin = value * SKETCH_RELATIVE_ERROR
+
+    return {
+        "rule_id": rule_id,
+        "from": start_time.isoformat(),
+        "to": end_time.isoformat(),
+        "active_users": value,
+        "relative_standard_error": round(SKETCH_RELATIVE_ERROR, 5),
+        "confidence_95": {
+            "low": max(0, int(value - 2 * margin)),
+            "high": int(value + 2 * margin) + 1 if value else 0,
+        },
+    }
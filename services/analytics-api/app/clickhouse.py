@@ -1,5 +1,16 @@
 import clickhouse_connect
-from app.core.config import settings
+from app.core.config import STATE_MODES, settings
+
+# Per-key value of the latest window. events_agg holds final values; the
+# state table holds partials that are merged on read, per metric.
+AGG_VALUE_SQL = "anyLast(value)"
+STATE_VALUE_SQL = """
+multiIf(
+    metric = 'active_users', uniqExactMerge(users),
+    metric = 'active_users_approx', uniqCombined64Merge(users_sketch),
+    sum(value)
+)
+"""
 
 
 class ClickHouseClient:
@@ -18,46 +29,61 @@ class ClickHouseClient:
         return self._client
 
     async def fetch_rule_stats(self, rule_id: str, top_n: int = 5):
+        """Latest window of a rule with its heaviest group keys."""
         client = await self.get_client()
 
-        main_query = """
-        SELECT
-            max(window_start) AS window_start,
-            sum(event_count) AS event_count,
-            max(active_users) AS active_users
-        FROM analytics.events_agg
-        WHERE rule_id = %(rule_id)s
-        """
-
-        top_events_query = """
-        SELECT
-            event_type,
-            sum(event_count) AS cnt
-        FROM analytics.events_agg
-        WHERE rule_id = %(rule_id)s
-        GROUP BY event_type
-        ORDER BY cnt DESC
-        LIMIT %(top_n)s
-        """
-
-        main = await client.query(main_query, parameters={"rule_id": rule_id})
-        top_events = await client.query(
-            top_events_query,
-            parameters={"rule_id": rule_id, "top_n": top_n},
+        # Precomputed at aggregation time for rules with top_n
+        top_row = await client.query(
+            """
+            SELECT window_start, metric, top_keys, top_values, other
+            FROM analytics.events_topn FINAL
+            WHERE rule_id = %(rule_id)s
+            ORDER BY window_start DESC
+            LIMIT 1
+            """,
+            parameters={"rule_id": rule_id},
         )
 
-        if not main.result_rows:
-            return None
+        if top_row.result_rows:
+            window_start, metric, keys, values, other = top_row.result_rows[0]
+            top_events = list(zip(keys, values))[:top_n]
+            total = sum(values) + other if metric == "event_count" else max(values, default=0)
+        else:
+            if settings.AGGREGATION_MODE in STATE_MODES:
+                value_sql, table = STATE_VALUE_SQL, "analytics.events_agg_state"
+            else:
+                value_sql, table = AGG_VALUE_SQL, "analytics.events_agg"
+
+            rows = await client.query(
+                f"""
+                SELECT window_start, metric, group_key, {value_sql} AS value
+                FROM {table}
+                WHERE rule_id = %(rule_id)s
+                  AND window_start = (
+                      SELECT max(window_start)
+                      FROM {table}
+                      WHERE rule_id = %(rule_id)s
+                  )
+                GROUP BY window_start, metric, group_key
+                ORDER BY value DESC
+                """,
+                parameters={"rule_id": rule_id},
+            )
+            if not rows.result_rows:
+                return None
 
-        row = main.result_rows[0]
+            window_start, metric = rows.result_rows[0][:2]
+            values = [r[3] for r in rows.result_rows]
+            top_events = [(r[2], r[3]) for r in rows.result_rows[:top_n]]
+            total = sum(values) if metric == "event_count" else max(values)
 
         return {
-            "window_start": row[0].isoformat() if row[0] else None,
-            "event_count": row[1],
-            "active_users": row[2],
+            "window_start": window_start.isoformat() if window_start else None,
+            "event_count": total if metric == "event_count" else None,
+            "active_users": total if metric != "event_count" else None,
             "top_events": [
-                {"event_type": r[0], "count": r[1]}
-                for r in top_events.result_rows
+                {"event_type": key, "count": count}
+                for key, count in top_events
             ],
         }
 
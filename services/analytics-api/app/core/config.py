@@ -13,6 +13,15 @@ class Settings(BaseSettings):
 
     WS_PUSH_INTERVAL: int = 5
 
+    # Rule registry fallback when Mongo has no change streams
+    RULES_RELOAD_SECONDS: float = 10.0
+    RULES_FULL_RELOAD_SECONDS: float = 300.0
+    # Startup fails if the first rule load takes longer
+    RULES_LOAD_TIMEOUT_SECONDS: float = 60.0
+
+    # Must match the event-processor: "poll", "materialized" or "streaming"
+    AGGREGATION_MODE: str = "poll"
+
     model_config = SettingsConfigDict(
         env_file=".env",
         env_file_encoding="utf-8",
@@ -20,3 +29,6 @@ class Settings(BaseSettings):
 
 
 settings = Settings()
+
+# Modes that write mergeable partial aggregates into events_agg_state
+STATE_MODES = ("materialized", "streaming")
@@ -0,0 +1,17 @@
+import asyncio
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
+from app.core.config import settings
+from app.registry import rule_registry
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    watcher = asyncio.create_task(rule_registry.run(), name="rule-registry")
+    try:
+        # Until the first load every rule lookup would answer 404
+        await rule_registry.wait_loaded(settings.RULES_LOAD_TIMEOUT_SECONDS)
+        yield
+    finally:
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
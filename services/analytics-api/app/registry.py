@@ -0,0 +1,131 @@
+import asyncio
+import logging
+from collections.abc import Mapping
+from datetime import datetime
+from types import MappingProxyType
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Mongo error code for change streams on a standalone server
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+
+class RuleRegistry:
+    """In-process cache of aggregation rule documents, keyed by rule_id.
+
+    Same scheme as the event-processor's registry: one full load, then a
+    change stream, or polling on ``updated_at`` plus a periodic full reload
+    when Mongo runs standalone. ``snapshot`` is read-only and replaced on
+    every change, so request handlers never query Mongo for rules.
+    """
+
+    def __init__(self, collection, poll_interval: float, full_reload_interval: float):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.full_reload_interval = full_reload_interval
+
+        self.snapshot: Mapping[str, Mapping] = MappingProxyType({})
+
+        self._rules: dict[str, Mapping] = {}
+        self._ids: dict[object, str] = {}
+        self._last_updated: datetime | None = None
+        self._loaded = asyncio.Event()
+
+    def get(self, rule_id: str) -> Mapping | None:
+        return self.snapshot.get(rule_id)
+
+    async def wait_loaded(self, timeout: float | None = None):
+        """Block until the first load; TimeoutError after ``timeout`` seconds."""
+        await asyncio.wait_for(self._loaded.wait(), timeout)
+
+    def _publish(self):
+        self.snapshot = MappingProxyType(dict(self._rules))
+
+    def _apply(self, doc: dict):
+        updated_at = doc.get("updated_at")
+        if updated_at and (
+            self._last_updated is None or updated_at > self._last_updated
+        ):
+            self._last_updated = updated_at
+
+        _id = doc.pop("_id")
+        rule_id = doc.get("rule_id")
+        self._ids[_id] = rule_id
+        self._rules[rule_id] = MappingProxyType(doc)
+
+    async def load(self):
+        self._rules = {}
+        self._ids = {}
+        async for doc in self.collection.find({}):
+            self._apply(doc)
+        self._publish()
+        self._loaded.set()
+
+    async def _watch(self):
+        async with self.collection.watch(full_document="updateLookup") as stream:
+            await self.load()
+            logger.info("📚 Rule registry loaded %d rules", len(self._rules))
+            async for change in stream:
+                if change["operationType"] == "delete":
+                    rule_id = self._ids.pop(change["documentKey"]["_id"], None)
+                    self._rules.pop(rule_id, None)
+                elif change.get("fullDocument") is not None:
+                    self._apply(change["fullDocument"])
+                else:
+                    continue
+                self._publish()
+
+    async def _poll(self):
+        await self.load()
+        elapsed = 0.0
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            elapsed += self.poll_interval
+
+            if elapsed >= self.full_reload_interval:
+                elapsed = 0.0
+                await self.load()
+                continue
+
+            # $gte: Mongo keeps milliseconds, so ties are re-read, not lost
+            query = {}
+            if self._last_updated is not None:
+                query = {"updated_at": {"$gte": self._last_updated}}
+
+            changed = False
+            async for doc in self.collection.find(query):
+                self._apply(doc)
+                changed = True
+            if changed:
+                self._publish()
+
+    async def run(self):
+        while True:
+            try:
+                await self._watch()
+            except Exception as e:
+                if (
+                    isinstance(e, OperationFailure)
+                    and e.code == CHANGE_STREAM_UNSUPPORTED
+                ):
+                    logger.info("Change streams unavailable, polling aggregation rules")
+                    break
+                logger.exception("❌ Rule change stream failed, reloading")
+                await asyncio.sleep(self.poll_interval)
+
+        while True:
+            try:
+                await self._poll()
+            except Exception:
+                logger.exception("❌ Rule polling failed")
+                await asyncio.sleep(self.poll_interval)
+
+
+rule_registry = RuleRegistry(
+    AsyncIOMotorClient(settings.MONGO_URI)[settings.MONGO_DB].aggregation_rules,
+    poll_interval=settings.RULES_RELOAD_SECONDS,
+    full_reload_interval=settings.RULES_FULL_RELOAD_SECONDS,
+)
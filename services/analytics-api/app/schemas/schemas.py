@@ -13,15 +13,27 @@ class AggregationRuleCreate(BaseModel):
         ...,
         example="10m",
     )
-    metric: Literal["event_count", "active_users"] = Field(
+    metric: Literal["event_count", "active_users", "active_users_approx"] = Field(
         ...,
         example="event_count",
+        description=(
+            "active_users_approx stores a HyperLogLog sketch per window that "
+            "/stats/active-users can merge over any time range"
+        ),
     )
     group_by: List[str] = Field(
         ...,
         example=["event_type"],
         min_items=1,
     )
+    group_mode: Literal["none", "rollup", "cube"] = Field(
+        "none",
+        example="rollup",
+        description=(
+            "rollup also stores every group_by prefix, cube every subset; "
+            "dropped columns are keyed as __all__"
+        ),
+    )
     top_n: int | None = Field(
         None,
         example=10,
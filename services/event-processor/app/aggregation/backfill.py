@@ -0,0 +1,242 @@
+"""Targeted re-aggregation of windows that received late events.
+
+The consumer reports the minutes its late events fall into; every active
+rule's window covering such a minute becomes one job in the
+``aggregation_backfill`` collection. Workers recompute those windows only,
+under a concurrency limit and a rows-per-second budget.
+
+Manual use, queues every window of a rule in [START, END):
+
+    python -m app.aggregation.backfill RULE_ID START END
+"""
+import argparse
+import asyncio
+import logging
+import time
+from collections.abc import Callable, Iterable
+from datetime import datetime, timedelta, timezone
+from pymongo import ASCENDING, UpdateOne
+from app.aggregation.engine import AggregationEngine
+from app.aggregation.planner import to_epoch
+from app.aggregation.registry import parse_rule
+from app.aggregation.rules import AggregationRule
+from app.columns import parse_timestamp
+from app.core.settings import settings
+from app.mongo import mongo_client
+
+logger = logging.getLogger(__name__)
+
+
+class RateBudget:
+    """Paces work to ``rate`` units per second, paid after the fact."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._free_at = time.monotonic()
+
+    async def spend(self, units: int):
+        now = time.monotonic()
+        self._free_at = max(self._free_at, now) + units / self.rate
+        await asyncio.sleep(max(0.0, self._free_at - now))
+
+
+class BackfillQueue:
+    def __init__(self, collection):
+        self.collection = collection
+
+    @staticmethod
+    def _job(rule_id: str, window_start: int, window_seconds: int, now: datetime):
+        return UpdateOne(
+            {"_id": f"{rule_id}|{window_start}"},
+            {
+                "$set": {
+                    "rule_id": rule_id,
+                    "window_start": datetime.fromtimestamp(window_start, timezone.utc),
+                    "window_seconds": window_seconds,
+                    "requested_at": now,
+                }
+            },
+            upsert=True,
+        )
+
+    async def enqueue_windows(self, jobs: Iterable[tuple[str, int, int]]) -> int:
+        """Upsert (rule_id, window start epoch, window seconds) jobs."""
+        now = datetime.utcnow()
+        ops = [
+            self._job(rule_id, start, seconds, now)
+            for rule_id, start, seconds in jobs
+        ]
+        if ops:
+            await self.collection.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    async def enqueue_late(
+        self,
+        rules: Iterable[AggregationRule],
+        minutes: set[int],
+        floors: dict[str, datetime],
+    ) -> int:
+        """Queue each rule window with a late minute before the rule's floor.
+
+        ``floors`` is where each rule's next scan can resume from at the
+        latest (see AggregationEngine.scan_floors); windows from there on
+        are rescanned anyway, and rules without a floor rescan everything.
+        """
+        jobs = set()
+        for rule in rules:
+            floor = floors.get(rule.rule_id)
+            if floor is None:
+                continue
+            window = rule.window_seconds
+            for minute in minutes:
+                start = minute * 60
+                start -= start % window
+                if start < to_epoch(floor):
+                    jobs.add((rule.rule_id, start, window))
+        return await self.enqueue_windows(jobs)
+
+    async def enqueue_range(
+        self, rule: AggregationRule, start: datetime, end: datetime
+    ) -> int:
+        window = rule.window_seconds
+        first = to_epoch(start) - to_epoch(start) % window
+        return await self.enqueue_windows(
+            (rule.rule_id, ws, window) for ws in range(first, to_epoch(end), window)
+        )
+
+    async def rekey(self, job: dict, rule: AggregationRule) -> int:
+        """Requeue a job queued under an old window size of ``rule``."""
+        start = job["window_start"]
+        end = start + timedelta(seconds=job["window_seconds"])
+        queued = await self.enqueue_range(rule, start, end)
+        await self.done(job)
+        return queued
+
+    async def pending(self, rule_ids: list[str], limit: int) -> list[dict]:
+        cursor = (
+            self.collection.find({"rule_id": {"$in": rule_ids}})
+            .sort("window_start", ASCENDING)
+            .limit(limit)
+        )
+        return [doc async for doc in cursor]
+
+    async def done(self, job: dict):
+        # Late data that re-queued the window meanwhile keeps the job alive
+        await self.collection.delete_one(
+            {"_id": job["_id"], "requested_at": job["requested_at"]}
+        )
+
+
+backfill_queue = BackfillQueue(mongo_client.db.aggregation_backfill)
+
+
+class BackfillWorker:
+    """Drains the backfill queue for the rules this replica owns."""
+
+    def __init__(
+        self,
+        engine: AggregationEngine,
+        rules: Callable[[], list[AggregationRule]],
+    ):
+        self.engine = engine
+        self.rules = rules
+        self.budget = RateBudget(settings.BACKFILL_ROWS_PER_SECOND)
+        self.semaphore = asyncio.Semaphore(max(1, settings.BACKFILL_CONCURRENCY))
+
+    async def _run_window(self, rules: list[AggregationRule], jobs: list[dict]):
+        # Mongo hands datetimes back naive, in UTC
+        epoch = to_epoch(jobs[0]["window_start"])
+        start = datetime.fromtimestamp(epoch, timezone.utc)
+        end = datetime.fromtimestamp(epoch + jobs[0]["window_seconds"], timezone.utc)
+
+        async with self.semaphore:
+            rows = await self.engine.recompute(rules, start, end)
+            logger.info(
+                "⏪ Backfilled %d rule(s) for [%s, %s), rows=%d",
+                len(rules),
+                start,
+                end,
+                rows,
+            )
+            for job in jobs:
+                await backfill_queue.done(job)
+            await self.budget.spend(rows)
+
+    async def run_once(self) -> int:
+        """Recompute one batch of queued windows; returns how many were handled."""
+        rules = {rule.rule_id: rule for rule in self.rules()}
+        if not rules:
+            return 0
+
+        jobs = await backfill_queue.pending(
+            list(rules), settings.BACKFILL_BATCH_SIZE
+        )
+
+        # Rules needing the same window share one scan
+        windows: dict[tuple, list[dict]] = {}
+        rekeyed = 0
+        for job in jobs:
+            rule = rules[job["rule_id"]]
+            if job["window_seconds"] != rule.window_seconds:
+                # The rule's window_size changed since: recomputing the old,
+                # narrower range would overwrite a whole new window with it
+                await backfill_queue.rekey(job, rule)
+                rekeyed += 1
+                continue
+            key = (job["window_start"], job["window_seconds"])
+            windows.setdefault(key, []).append(job)
+
+        results = await asyncio.gather(
+            *(
+                self._run_window([rules[j["rule_id"]] for j in jobs], jobs)
+                for jobs in windows.values()
+            ),
+            return_exceptions=True,
+        )
+        succeeded = rekeyed
+        for window_jobs, result in zip(windows.values(), results):
+            if isinstance(result, Exception):
+                logger.error("❌ Backfill window failed", exc_info=result)
+            else:
+                succeeded += len(window_jobs)
+        return succeeded
+
+    async def run(self):
+        while True:
+            try:
+                if await self.run_once():
+                    continue
+            except Exception:
+                logger.exception("❌ Backfill worker failure")
+            await asyncio.sleep(settings.BACKFILL_IDLE_SECONDS)
+
+
+async def _enqueue_from_cli(rule_id: str, start: datetime, end: datetime):
+    doc = await mongo_client.db.aggregation_rules.find_one({"rule_id": rule_id})
+    if doc is None:
+        raise SystemExit(f"Unknown rule: {rule_id}")
+
+    rule = parse_rule(doc)
+    rule.validate()
+    queued = await backfill_queue.enqueue_range(rule, start, end)
+    print(f"Queued {queued} window(s) of {rule_id} for re-aggregation")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Queue a time range of a rule for re-aggregation"
+    )
+    parser.add_argument("rule_id")
+    parser.add_argument("start", help="ISO 8601, inclusive")
+    parser.add_argument("end", help="ISO 8601, exclusive")
+    args = parser.parse_args()
+
+    start, end = parse_timestamp(args.start), parse_timestamp(args.end)
+    if start is None or end is None or start >= end:
+        parser.error("START and END must be ISO 8601 timestamps with START < END")
+
+    asyncio.run(_enqueue_from_cli(args.rule_id, start, end))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,293 @@
+import asyncio
+from collections.abc import Coroutine
+from datetime import datetime
 from app.clickhouse import clickhouse_client
-from app.aggregation.rules import AggregationRule
+from app.aggregation.rules import (
+    AggregationRule,
+    METRIC_STATES,
+    group_key_sql,
+    group_values_sql,
+)
+from app.aggregation.planner import (
+    Rollup,
+    ScanGroup,
+    plan_rollups,
+    plan_scans,
+    rule_since,
+    to_epoch,
+    window_floor,
+)
+from app.core.settings import settings
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Final value per metric in the shared scan; only the matching rows feed
+# each distinct-count aggregate
+SCAN_VALUE_SQL = "multiIf({}, count())".format(
+    ", ".join(
+        f"metric = '{m}', {fn}If(user_id, metric = '{m}')"
+        for m, (_, fn) in METRIC_STATES.items()
+    )
+)
+SCAN_STATE_COLUMNS = ", ".join(col for col, _ in METRIC_STATES.values())
+SCAN_STATE_SQL = ",\n            ".join(
+    f"{fn}StateIf(user_id, metric = '{m}') AS {col}"
+    for m, (col, fn) in METRIC_STATES.items()
+)
+
+# Future-dated events wait until their time comes: aggregating one now would
+# move the watermark past every current event for good
+FACT_HORIZON_SQL = "timestamp <= now()"
+
+# Key components for the scan tuple's column names and grouping-set mask
+SCAN_GROUP_VALUES_SQL = group_values_sql("r.4", "r.6")
+
 
 class AggregationEngine:
+    async def get_watermarks(
+        self, client, rule_ids: list[str]
+    ) -> dict[str, datetime | None]:
+        """Start of the last (still open) window aggregated for each rule."""
+        result = await client.query(
+            """
+            SELECT rule_id, max(last_window_start)
+            FROM analytics.aggregation_state
+            WHERE rule_id IN %(rule_ids)s
+            GROUP BY rule_id
+            """,
+            parameters={"rule_ids": rule_ids},
+        )
+        watermarks = dict.fromkeys(rule_ids)
+        watermarks.update({row[0]: row[1] for row in result.result_rows})
+        return watermarks
+
+    async def scan_floors(
+        self, rules: list[AggregationRule]
+    ) -> dict[str, datetime]:
+        """Latest point each rule's next scan can resume from.
+
+        Events before it are only picked up by a backfill. A run in flight
+        may still move a watermark, but never past the newest event already
+        in events_fact, so that bounds every rule. Rules that never ran
+        rescan all history and are left out.
+        """
+        client = await clickhouse_client.get_client()
+        watermarks = await self.get_watermarks(client, [r.rule_id for r in rules])
+        # The part minmax index spares a scan of the timestamp column
+        result = await client.query(
+            """
+            SELECT max(max_time)
+            FROM system.parts
+            WHERE database = 'analytics'
+              AND table = 'events_fact'
+              AND active
+              AND max_time <= now()
+            """
+        )
+        newest = result.result_rows[0][0]
+        return {
+            rule.rule_id: rule_since(
+                rule, newest, settings.AGGREGATION_LATENESS_SECONDS
+            )
+            for rule in rules
+            if watermarks.get(rule.rule_id) is not None
+        }
+
+    async def set_watermarks(self, client, watermarks: dict[str, datetime]):
+        if not watermarks:
+            return
+        await client.insert(
+            "aggregation_state",
+            [[rule_id, ws] for rule_id, ws in watermarks.items()],
+            column_names=["rule_id", "last_window_start"],
+        )
+
     async def run_rule(self, rule: AggregationRule):
+        await self.run_rules([rule])
+
+    async def data_version(self) -> tuple:
+        """Cheap fingerprint of events_fact; changes whenever a part is written.
+
+        Merges change it too, which at worst costs one redundant run.
+        """
         client = await clickhouse_client.get_client()
+        result = await client.query(
+            """
+            SELECT count(), max(modification_time), sum(rows)
+            FROM system.parts
+            WHERE database = 'analytics'
+              AND table = 'events_fact'
+              AND active
+            """
+        )
+        return tuple(result.result_rows[0])
 
-        value, unit = rule.ch_interval
-        metric = rule.metric
-        group_col = rule.group_by[0]  # event_type
+    async def run_rules(
+        self,
+        rules: list[AggregationRule],
+        sources: list[AggregationRule] | None = None,
+    ) -> set[str]:
+        """Evaluate rules with as few passes over events_fact as possible.
+
+        ``sources`` are further rules whose stored aggregates ``rules`` may
+        roll up from without running them now. Returns the ids of rules
+        whose queries failed.
+        """
+        runnable = []
+        for rule in rules:
+            try:
+                rule.validate()
+            except ValueError as e:
+                logger.warning("Rule %s skipped: %s", rule.rule_id, e)
+                continue
+            runnable.append(rule)
+
+        if not runnable:
+            return set()
+
+        # Top-N rules keep only their heaviest keys, so they are neither
+        # shareable scans nor complete enough to be rollup sources.
+        top_n = [r for r in runnable if r.top_n]
+        full = [r for r in runnable if not r.top_n]
+
+        running = {r.rule_id for r in runnable}
+        idle_sources = []
+        for rule in sources or ():
+            if rule.rule_id in running or rule.top_n:
+                continue
+            try:
+                rule.validate()
+            except ValueError:
+                continue
+            idle_sources.append(rule)
 
-        metric_sql = {
-            "event_count": "count()",
-            "active_users": "uniqExact(user_id)",
-        }.get(metric)
+        client = await clickhouse_client.get_client()
+        watermarks = await self.get_watermarks(
+            client, [r.rule_id for r in runnable + idle_sources]
+        )
+
+        raw, rollups = plan_rollups(
+            full,
+            watermarks,
+            lateness_seconds=settings.AGGREGATION_LATENESS_SECONDS,
+            sources=full + idle_sources,
+        )
+
+        groups = plan_scans(
+            raw,
+            watermarks,
+            lateness_seconds=settings.AGGREGATION_LATENESS_SECONDS,
+            max_rules_per_scan=settings.AGGREGATION_MAX_RULES_PER_SCAN,
+            max_spread_seconds=settings.AGGREGATION_MAX_SCAN_SPREAD_SECONDS,
+        )
+        semaphore = asyncio.Semaphore(max(1, settings.AGGREGATION_CONCURRENCY))
+        failed = await self._gather(
+            semaphore,
+            [(g.rules, self.run_group(client, g, watermarks)) for g in groups]
+            + [([r], self.run_top_n(client, r, watermarks)) for r in top_n],
+        )
+
+        # Rollups read what the scans just wrote, and each tier what the
+        # finer one just wrote: tiers run in order, concurrently within one
+        tiers: dict[int, list[Rollup]] = {}
+        for rollup in rollups:
+            tiers.setdefault(rollup.rule.window_seconds, []).append(rollup)
+
+        for window_seconds in sorted(tiers):
+            runs = []
+            for rollup in tiers[window_seconds]:
+                if rollup.source.rule_id in failed:
+                    # A stale source would advance the watermark over gaps
+                    failed.add(rollup.rule.rule_id)
+                    continue
+                runs.append(
+                    ([rollup.rule], self.run_rollup(client, rollup, watermarks))
+                )
+            failed |= await self._gather(semaphore, runs)
+        return failed
 
-        if not metric_sql:
-            raise ValueError(f"Unsupported metric: {metric}")
+    async def _gather(
+        self,
+        semaphore: asyncio.Semaphore,
+        runs: list[tuple[list[AggregationRule], Coroutine]],
+    ) -> set[str]:
+        """Run at most ``semaphore`` queries at once; one failure skips only itself."""
+
+        async def bounded(run):
+            async with semaphore:
+                await run
+
+        results = await asyncio.gather(
+            *(bounded(run) for _, run in runs), return_exceptions=True
+        )
+
+        failed = set()
+        for (rules, _), result in zip(runs, results):
+            if isinstance(result, Exception):
+                logger.error(
+                    "❌ Aggregation failed for rules %s",
+                    [r.rule_id for r in rules],
+                    exc_info=result,
+                )
+                failed.update(r.rule_id for r in rules)
+        return failed
+
+    async def run_group(
+        self,
+        client,
+        group: ScanGroup,
+        watermarks: dict[str, datetime | None],
+        until: datetime | None = None,
+    ) -> int:
+        """Aggregate a scan group; with ``until`` only up to it, watermarks untouched.
+
+        Returns the number of events_fact rows scanned.
+        """
+        scan_since = group.scan_since
+
+        params: dict = {}
+        where_sql = FACT_HORIZON_SQL
+        if scan_since is not None:
+            params["since"] = scan_since
+            where_sql += " AND timestamp >= %(since)s"
+        if until is not None:
+            params["until"] = until
+            where_sql += " AND timestamp < %(until)s"
+
+        # Upper bound is taken before the insert: rows arriving meanwhile
+        # land in windows >= the new watermarks and are picked up next run.
+        probe = await client.query(
+            f"""
+            SELECT count(), max(timestamp)
+            FROM analytics.events_fact
+            WHERE {where_sql}
+            """,
+            parameters=params,
+        )
+        rows, last_ts = probe.result_rows[0]
+        if not rows:
+            logger.debug(
+                "No new events for rules %s", [r.rule_id for r in group.rules]
+            )
+            return 0
+
+        # One tuple per rule and ROLLUP/CUBE grouping set: (rule_id, window
+        # seconds, metric, group columns, first epoch second to aggregate,
+        # mask). A single ARRAY JOIN fans every scanned row out to the rules
+        # that still need it; ClickHouse 23.8 rejects a second one.
+        params["rules"] = [
+            (
+                r.rule_id,
+                r.window_seconds,
+                r.metric,
+                r.group_columns,
+                to_epoch(group.since[r.rule_id]) if group.since[r.rule_id] else 0,
+                mask,
+            )
+            for r in group.rules
+            for mask in r.group_masks
+        ]
 
         sql = f"""
         INSERT INTO analytics.events_agg
@@ -27,25 +295,262 @@ class AggregationEngine:
             rule_id,
             window_start,
             metric,
+            group_values,
             group_key,
-            value
+            value,
+            {SCAN_STATE_COLUMNS}
         )
         SELECT
-            %(rule_id)s                                         AS rule_id,
-            toStartOfInterval(timestamp, INTERVAL {value} {unit}) AS window_start,
-            %(metric)s                                          AS metric,
-            {group_col}                                         AS group_key,
-            {metric_sql}                                        AS value
+            r.1                                                      AS rule_id,
+            toDateTime(intDiv(toUInt32(timestamp), r.2) * r.2, 'UTC') AS window_start,
+            r.3                                                      AS metric,
+            {SCAN_GROUP_VALUES_SQL}                                  AS group_values,
+            {group_key_sql("group_values")}                          AS group_key,
+            {SCAN_VALUE_SQL}                                         AS value,
+            {SCAN_STATE_SQL}
         FROM analytics.events_fact
+        ARRAY JOIN %(rules)s AS r
+        WHERE {where_sql}
+          AND toUInt32(timestamp) >= r.5
         GROUP BY
+            rule_id,
             window_start,
+            metric,
+            group_values
+        """
+
+        logger.info(
+            "🚀 Running %d aggregation rule(s) in one scan (since=%s, rows=%d)",
+            len(group.rules),
+            scan_since,
+            rows,
+        )
+        await client.command(sql, parameters=params)
+
+        if until is None:
+            await self._advance(client, group.rules, last_ts, watermarks)
+        return rows
+
+    async def run_rollup(
+        self,
+        client,
+        rollup: Rollup,
+        watermarks: dict[str, datetime | None],
+    ):
+        rule, source = rollup.rule, rollup.source
+
+        params = {
+            "rule_id": rule.rule_id,
+            "source_id": source.rule_id,
+            "window": rule.window_seconds,
+        }
+        where_sql = "rule_id = %(source_id)s"
+        if rollup.since is not None:
+            params["since"] = rollup.since
+            where_sql += " AND window_start >= %(since)s"
+
+        probe = await client.query(
+            f"""
+            SELECT count(), max(window_start)
+            FROM analytics.events_agg
+            WHERE {where_sql}
+            """,
+            parameters=params,
+        )
+        rows, last_window = probe.result_rows[0]
+        if not rows:
+            return
+
+        # Distinct counts merge the stored states; rolled-up rows keep a state
+        # of their own so they can in turn feed an even coarser rule.
+        value_sql, state_column, state_sql = "sum(value)", "", ""
+        if rule.metric in METRIC_STATES:
+            col, fn = METRIC_STATES[rule.metric]
+            value_sql = f"{fn}Merge({col})"
+            state_column = f", {col}"
+            state_sql = f", {fn}MergeState({col})"
+
+        sql = f"""
+        INSERT INTO analytics.events_agg
+        (rule_id, window_start, metric, group_key, group_values, value{state_column})
+        SELECT
+            %(rule_id)s,
+            toDateTime(intDiv(toUInt32(window_start), %(window)s) * %(window)s, 'UTC')
+                AS rolled_window,
+            metric,
+            group_key,
+            any(group_values),
+            {value_sql}
+            {state_sql}
+        FROM analytics.events_agg FINAL
+        WHERE {where_sql}
+        GROUP BY
+            rolled_window,
+            metric,
             group_key
         """
 
+        logger.info(
+            "🧮 Rolling up rule %s from %s (since=%s, rows=%d)",
+            rule.rule_id,
+            source.rule_id,
+            rollup.since,
+            rows,
+        )
+        await client.command(sql, parameters=params)
+
+        await self._advance(client, [rule], last_window, watermarks)
+
+    async def run_top_n(
+        self,
+        client,
+        rule: AggregationRule,
+        watermarks: dict[str, datetime | None],
+        since: datetime | None = None,
+        until: datetime | None = None,
+    ) -> int:
+        """Store only the top ``rule.top_n`` group keys per window.
+
+        Ranking stays exact, so the scan still aggregates every key; only
+        what is stored and served is cut to N.
+
+        With ``until`` only [since, until) is recomputed and the watermark
+        stays put. Returns the number of events_fact rows scanned.
+        """
+        value, unit = rule.ch_interval
+        if until is None:
+            since = rule_since(
+                rule,
+                watermarks.get(rule.rule_id),
+                settings.AGGREGATION_LATENESS_SECONDS,
+            )
+
         params = {
             "rule_id": rule.rule_id,
-            "metric": metric,
+            "metric": rule.metric,
+            "top_n": rule.top_n,
         }
+        where_sql = FACT_HORIZON_SQL
+        if since is not None:
+            params["since"] = since
+            where_sql += " AND timestamp >= %(since)s"
+        if until is not None:
+            params["until"] = until
+            where_sql += " AND timestamp < %(until)s"
 
-        logger.info("🚀 Running aggregation rule: %s", rule.rule_id)
+        probe = await client.query(
+            f"""
+            SELECT count(), max(timestamp)
+            FROM analytics.events_fact
+            WHERE {where_sql}
+            """,
+            parameters=params,
+        )
+        rows, last_ts = probe.result_rows[0]
+        if not rows:
+            return 0
+
+        # Per window: keep the N largest keys with LIMIT BY, so only N rows
+        # per window are collected into arrays and stored. This bounds the
+        # output, not the scan: the exact per-key GROUP BY below (and the
+        # window total) still holds every key of the scanned windows, so
+        # its memory grows with key cardinality like any other rule. For
+        # event_count the remainder is folded into `other`; distinct counts
+        # are not additive across keys, so there it stays 0.
+        sql = f"""
+        INSERT INTO analytics.events_topn
+        (rule_id, window_start, metric, top_keys, top_values, other)
+        SELECT
+            %(rule_id)s,
+            window_start,
+            %(metric)s,
+            arrayMap(x -> x.1, top) AS top_keys,
+            arrayMap(x -> x.2, top) AS top_values,
+            if(%(metric)s = 'event_count', total - arraySum(top_values), 0)
+        FROM
+        (
+            SELECT
+                window_start,
+                arrayReverseSort(x -> x.2, groupArray((group_key, value))) AS top,
+                any(total) AS total
+            FROM
+            (
+                SELECT
+                    window_start,
+                    group_key,
+                    value,
+                    sum(value) OVER (PARTITION BY window_start) AS total
+                FROM
+                (
+                    SELECT
+                        toStartOfInterval(timestamp, INTERVAL {value} {unit}) AS window_start,
+                        {group_key_sql(rule.group_values_sql)} AS group_key,
+                        {rule.metric_sql}                                     AS value
+                    FROM analytics.events_fact
+                    ARRAY JOIN {rule.masks_sql} AS mask
+                    WHERE {where_sql}
+                    GROUP BY
+                        window_start,
+                        group_key
+                )
+                ORDER BY
+                    window_start,
+                    value DESC,
+                    group_key
+                LIMIT %(top_n)s BY window_start
+            )
+            GROUP BY window_start
+        )
+        """
+
+        logger.info(
+            "🏆 Running top-%d rule %s (since=%s, rows=%d)",
+            rule.top_n,
+            rule.rule_id,
+            since,
+            rows,
+        )
         await client.command(sql, parameters=params)
+
+        if until is None:
+            await self._advance(client, [rule], last_ts, watermarks)
+        return rows
+
+    async def recompute(
+        self,
+        rules: list[AggregationRule],
+        start: datetime,
+        end: datetime,
+    ) -> int:
+        """Re-aggregate [start, end) from events_fact for rules sharing that range.
+
+        Used for late data: cost is proportional to the range, and the
+        rules' watermarks are left alone. Returns the rows scanned.
+        """
+        client = await clickhouse_client.get_client()
+
+        full = [r for r in rules if not r.top_n]
+        rows = 0
+        if full:
+            group = ScanGroup(full, {r.rule_id: start for r in full})
+            rows += await self.run_group(client, group, {}, until=end)
+        for rule in rules:
+            if rule.top_n:
+                rows += await self.run_top_n(client, rule, {}, since=start, until=end)
+        return rows
+
+    async def _advance(
+        self,
+        client,
+        rules: list[AggregationRule],
+        last_ts: datetime,
+        watermarks: dict[str, datetime | None],
+    ):
+        advanced = {}
+        for rule in rules:
+            last_window = window_floor(last_ts, rule.window_seconds)
+            previous = watermarks.get(rule.rule_id)
+            if previous is None or to_epoch(last_window) > to_epoch(previous):
+                advanced[rule.rule_id] = last_window
+                watermarks[rule.rule_id] = last_window
+        await self.set_watermarks(client, advanced)
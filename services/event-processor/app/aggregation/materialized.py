@@ -0,0 +1,162 @@
+import asyncio
+import hashlib
+import logging
+import re
+from datetime import timedelta
+from app.clickhouse import clickhouse_client
+from app.aggregation.rules import AggregationRule, group_key_sql
+from app.core.settings import settings
+
+logger = logging.getLogger(__name__)
+
+VIEW_PREFIX = "mv_rule_"
+
+# Per-rule state expressions written into analytics.events_agg_state
+METRIC_TO_STATE_SQL = {
+    "event_count": "count() AS value",
+    "active_users": "toUInt64(0) AS value, uniqExactState(user_id) AS users",
+    "active_users_approx": (
+        "toUInt64(0) AS value, uniqCombined64State(user_id) AS users_sketch"
+    ),
+}
+
+# State columns filled by the backfill, besides `value`
+METRIC_TO_STATE_COLUMNS = {
+    "active_users": ", users",
+    "active_users_approx": ", users_sketch",
+}
+
+
+def view_name(rule: AggregationRule) -> str:
+    """Stable view name; changes whenever the rule definition changes."""
+    definition = "|".join(
+        [
+            rule.rule_id,
+            rule.window_size,
+            rule.metric,
+            ",".join(rule.group_by),
+            rule.group_mode,
+        ]
+    )
+    digest = hashlib.sha1(definition.encode()).hexdigest()[:12]
+    slug = re.sub(r"[^A-Za-z0-9_]", "_", rule.rule_id)[:40]
+    return f"{VIEW_PREFIX}{slug}_{digest}"
+
+
+class MaterializedViewManager:
+    """Keeps one ClickHouse materialized view per active rule.
+
+    Views aggregate into the shared AggregatingMergeTree
+    ``analytics.events_agg_state`` as parts are inserted into
+    ``events_fact``, whatever their event time, so late events still count.
+    Rows are split by insert time instead, at a cutoff a little after the
+    view is created: the view takes rows inserted from the cutoff on, a
+    one-off backfill everything inserted before it.
+    """
+
+    def _select_sql(self, rule: AggregationRule, where_sql: str | None = None) -> str:
+        value, unit = rule.ch_interval
+
+        state_sql = METRIC_TO_STATE_SQL.get(rule.metric)
+        if not state_sql:
+            raise ValueError(f"Unsupported metric: {rule.metric}")
+
+        where = f"WHERE {where_sql}" if where_sql else ""
+        return f"""
+        SELECT
+            %(rule_id)s                                           AS rule_id,
+            toStartOfInterval(timestamp, INTERVAL {value} {unit}) AS window_start,
+            %(metric)s                                            AS metric,
+            {rule.group_values_sql} AS group_values,
+            {group_key_sql("group_values")} AS group_key,
+            {state_sql}
+        FROM analytics.events_fact
+        ARRAY JOIN {rule.masks_sql} AS mask
+        {where}
+        GROUP BY
+            window_start,
+            group_values
+        """
+
+    async def existing_views(self) -> set[str]:
+        client = await clickhouse_client.get_client()
+        result = await client.query(
+            """
+            SELECT name
+            FROM system.tables
+            WHERE database = 'analytics'
+              AND engine = 'MaterializedView'
+              AND startsWith(name, %(prefix)s)
+            """,
+            parameters={"prefix": VIEW_PREFIX},
+        )
+        return {row[0] for row in result.result_rows}
+
+    async def create(self, rule: AggregationRule):
+        client = await clickhouse_client.get_client()
+        name = view_name(rule)
+        params = {"rule_id": rule.rule_id, "metric": rule.metric}
+
+        # Leftovers from an earlier definition of the same rule_id would be
+        # merged into the new aggregates otherwise.
+        await client.command(
+            "ALTER TABLE analytics.events_agg_state "
+            "DELETE WHERE rule_id = %(rule_id)s",
+            parameters=params,
+            settings={"mutations_sync": 1},
+        )
+
+        # Inserts that started before the view existed skip it, and ones
+        # stamped just before the cutoff may still be committing: the margin
+        # on both sides of the cutoff covers either kind of straggler.
+        margin = settings.AGGREGATION_VIEW_CUTOFF_SECONDS
+        result = await client.query("SELECT now()")
+        params["cutoff"] = result.result_rows[0][0] + timedelta(seconds=margin)
+
+        await client.command(
+            f"CREATE MATERIALIZED VIEW IF NOT EXISTS analytics.`{name}` "
+            "TO analytics.events_agg_state AS "
+            + self._select_sql(rule, "inserted_at >= %(cutoff)s"),
+            parameters=params,
+        )
+        logger.info(
+            "🧩 Materialized view %s created for rule %s", name, rule.rule_id
+        )
+
+        await asyncio.sleep(2 * margin)
+        await client.command(
+            "INSERT INTO analytics.events_agg_state "
+            "(rule_id, window_start, metric, group_values, group_key, value"
+            + METRIC_TO_STATE_COLUMNS.get(rule.metric, "")
+            + ") "
+            + self._select_sql(rule, "inserted_at < %(cutoff)s"),
+            parameters=params,
+        )
+        logger.info(
+            "✅ Backfill done for rule %s (inserted before %s)",
+            rule.rule_id,
+            params["cutoff"],
+        )
+
+    async def drop(self, name: str):
+        client = await clickhouse_client.get_client()
+        await client.command(f"DROP VIEW IF EXISTS analytics.`{name}`")
+        logger.info("🗑️ Materialized view %s dropped", name)
+
+    async def sync(self, rules: list[AggregationRule]):
+        """Create views for new or changed rules, drop views of inactive ones.
+
+        Top-N rules get no view; the scheduler polls them instead.
+        """
+        wanted = {view_name(rule): rule for rule in rules if not rule.top_n}
+        existing = await self.existing_views()
+
+        for name in existing - wanted.keys():
+            await self.drop(name)
+
+        for name in wanted.keys() - existing:
+            try:
+                await self.create(wanted[name])
+            except Exception:
+                logger.exception("❌ Failed to materialize rule %s", wanted[name].rule_id)
+                await self.drop(name)
@@ -0,0 +1,162 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from app.aggregation.rules import AggregationRule
+
+
+def to_epoch(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def window_floor(dt: datetime, window_seconds: int) -> datetime:
+    """Python twin of toStartOfInterval for MINUTE/HOUR windows in UTC."""
+    epoch = to_epoch(dt)
+    return datetime.fromtimestamp(epoch - epoch % window_seconds, tz=timezone.utc)
+
+
+@dataclass
+class ScanGroup:
+    """Rules evaluated together in one pass over events_fact."""
+
+    rules: list[AggregationRule] = field(default_factory=list)
+    # first event time each rule still has to (re)aggregate, None = all history
+    since: dict[str, datetime | None] = field(default_factory=dict)
+
+    @property
+    def scan_since(self) -> datetime | None:
+        starts = [self.since[r.rule_id] for r in self.rules]
+        if any(s is None for s in starts):
+            return None
+        return min(starts)
+
+
+def rule_since(
+    rule: AggregationRule,
+    watermark: datetime | None,
+    lateness_seconds: int,
+) -> datetime | None:
+    if watermark is None:
+        return None
+    return window_floor(
+        watermark - timedelta(seconds=lateness_seconds),
+        rule.window_seconds,
+    )
+
+
+def plan_scans(
+    rules: list[AggregationRule],
+    watermarks: dict[str, datetime | None],
+    lateness_seconds: int,
+    max_rules_per_scan: int,
+    max_spread_seconds: int,
+) -> list[ScanGroup]:
+    """Group rules whose pending ranges overlap so they share one scan.
+
+    Rules that have never run need the full history and are scanned
+    together. The rest are sorted by where they resume; a new group starts
+    when it is full or when the next rule would stretch the scanned range by
+    more than ``max_spread_seconds`` (a lagging rule shouldn't drag every
+    other rule's scan back in time with it).
+    """
+    since = {
+        r.rule_id: rule_since(r, watermarks.get(r.rule_id), lateness_seconds)
+        for r in rules
+    }
+
+    fresh = [r for r in rules if since[r.rule_id] is None]
+    incremental = sorted(
+        (r for r in rules if since[r.rule_id] is not None),
+        key=lambda r: since[r.rule_id],
+        reverse=True,
+    )
+
+    groups: list[ScanGroup] = []
+
+    for start in range(0, len(fresh), max_rules_per_scan):
+        chunk = fresh[start:start + max_rules_per_scan]
+        groups.append(ScanGroup(chunk, {r.rule_id: None for r in chunk}))
+
+    current: ScanGroup | None = None
+    newest: datetime | None = None
+    for rule in incremental:
+        rule_start = since[rule.rule_id]
+        if (
+            current is None
+            or len(current.rules) >= max_rules_per_scan
+            or (newest - rule_start).total_seconds() > max_spread_seconds
+        ):
+            current = ScanGroup()
+            newest = rule_start
+            groups.append(current)
+
+        current.rules.append(rule)
+        current.since[rule.rule_id] = rule_start
+
+    return groups
+
+
+@dataclass
+class Rollup:
+    """A coarse rule derived from an already aggregated finer rule."""
+
+    rule: AggregationRule
+    source: AggregationRule
+    since: datetime | None
+
+
+def rollup_source(
+    rule: AggregationRule,
+    candidates: list[AggregationRule],
+    watermarks: dict[str, datetime | None],
+) -> AggregationRule | None:
+    """Coarsest finer rule with the same metric and grouping, if any.
+
+    Only sources that have been aggregated at least once qualify: their
+    first run covers all history, so any window they produced is complete
+    from the start.
+    """
+    best = None
+    for source in candidates:
+        if (
+            source.rule_id != rule.rule_id
+            and source.metric == rule.metric
+            and list(source.group_by) == list(rule.group_by)
+            and source.group_mode == rule.group_mode
+            and source.window_seconds < rule.window_seconds
+            and rule.window_seconds % source.window_seconds == 0
+            and watermarks.get(source.rule_id) is not None
+        ):
+            if best is None or source.window_seconds > best.window_seconds:
+                best = source
+    return best
+
+
+def plan_rollups(
+    rules: list[AggregationRule],
+    watermarks: dict[str, datetime | None],
+    lateness_seconds: int,
+    sources: list[AggregationRule] | None = None,
+) -> tuple[list[AggregationRule], list[Rollup]]:
+    """Split rules into those that need raw events and those that can roll up.
+
+    ``sources`` are the candidate rollup sources, ``rules`` by default; they
+    need not run in this cycle themselves (``watermarks`` must cover them).
+    Rollups are returned finest first, so a chain like 1m -> 10m -> 1h
+    reads sources that were refreshed earlier in the same cycle.
+    """
+    raw: list[AggregationRule] = []
+    rollups: list[Rollup] = []
+    if sources is None:
+        sources = rules
+
+    for rule in rules:
+        source = rollup_source(rule, sources, watermarks)
+        if source is None:
+            raw.append(rule)
+        else:
+            since = rule_since(rule, watermarks.get(rule.rule_id), lateness_seconds)
+            rollups.append(Rollup(rule, source, since))
+
+    rollups.sort(key=lambda r: r.rule.window_seconds)
+    return raw, rollups
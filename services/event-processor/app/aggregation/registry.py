@@ -0,0 +1,175 @@
+import asyncio
+import logging
+from collections.abc import Mapping
+from datetime import datetime
+from types import MappingProxyType
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import OperationFailure
+from app.aggregation.rules import AggregationRule
+from app.core.settings import settings
+
+logger = logging.getLogger(__name__)
+
+# Mongo error code for change streams on a standalone server
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+
+def parse_rule(doc: dict) -> AggregationRule:
+    return AggregationRule(
+        rule_id=doc["rule_id"],
+        window_size=doc["window_size"],
+        metric=doc["metric"],
+        group_by=doc["group_by"],
+        top_n=doc.get("top_n"),
+        group_mode=doc.get("group_mode", "none"),
+    )
+
+
+class RuleRegistry:
+    """In-process cache of active aggregation rules.
+
+    Rules are loaded once, then kept current from a change stream on the
+    rules collection. Without one (standalone Mongo) the registry polls for
+    documents whose ``updated_at`` moved and reloads everything now and
+    then to notice hard deletes. Readers get an immutable ``snapshot`` that
+    is swapped, never mutated, so it is safe to hold across awaits.
+    """
+
+    def __init__(
+        self,
+        collection,
+        poll_interval: float,
+        full_reload_interval: float,
+    ):
+        self.collection = collection
+        self.poll_interval = poll_interval
+        self.full_reload_interval = full_reload_interval
+
+        self.snapshot: Mapping[str, AggregationRule] = MappingProxyType({})
+        # bumped on every change, lets readers skip work when nothing moved
+        self.version = 0
+
+        self._rules: dict[str, AggregationRule] = {}
+        # Mongo _id -> rule_id, delete events only carry the _id
+        self._ids: dict[object, str] = {}
+        self._last_updated: datetime | None = None
+        self._loaded = asyncio.Event()
+
+    def active_rules(self) -> list[AggregationRule]:
+        return list(self.snapshot.values())
+
+    async def wait_loaded(self, timeout: float | None = None):
+        """Block until the first load; TimeoutError after ``timeout`` seconds."""
+        await asyncio.wait_for(self._loaded.wait(), timeout)
+
+    def _publish(self):
+        self.snapshot = MappingProxyType(dict(self._rules))
+        self.version += 1
+
+    def _apply(self, doc: dict) -> bool:
+        """Fold one rule document into the cache; True if anything changed."""
+        updated_at = doc.get("updated_at")
+        if updated_at and (
+            self._last_updated is None or updated_at > self._last_updated
+        ):
+            self._last_updated = updated_at
+
+        rule_id = doc.get("rule_id")
+        self._ids[doc["_id"]] = rule_id
+
+        rule = None
+        if doc.get("is_active"):
+            try:
+                rule = parse_rule(doc)
+            except KeyError as e:
+                logger.warning("Invalid rule skipped: %s (missing %s)", rule_id, e)
+
+        if rule is None:
+            return self._rules.pop(rule_id, None) is not None
+        if self._rules.get(rule_id) == rule:
+            return False
+        self._rules[rule_id] = rule
+        return True
+
+    def _remove(self, _id) -> bool:
+        rule_id = self._ids.pop(_id, None)
+        return self._rules.pop(rule_id, None) is not None
+
+    async def load(self):
+        previous = self._rules
+        self._rules = {}
+        self._ids = {}
+        async for doc in self.collection.find({}):
+            self._apply(doc)
+
+        if self._rules != previous or not self._loaded.is_set():
+            self._publish()
+            logger.info("📚 Rule registry loaded %d active rules", len(self._rules))
+        self._loaded.set()
+
+    async def _watch(self):
+        # The stream is opened before the load so nothing falls in between;
+        # events replayed over the loaded state carry the current document.
+        async with self.collection.watch(full_document="updateLookup") as stream:
+            await self.load()
+            async for change in stream:
+                op = change["operationType"]
+                if op == "delete":
+                    changed = self._remove(change["documentKey"]["_id"])
+                elif change.get("fullDocument") is not None:
+                    changed = self._apply(change["fullDocument"])
+                else:
+                    continue
+                if changed:
+                    self._publish()
+
+    async def _poll(self):
+        await self.load()
+        elapsed = 0.0
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            elapsed += self.poll_interval
+
+            if elapsed >= self.full_reload_interval:
+                elapsed = 0.0
+                await self.load()
+                continue
+
+            # $gte: Mongo keeps milliseconds, so ties are re-read, not lost
+            query = {}
+            if self._last_updated is not None:
+                query = {"updated_at": {"$gte": self._last_updated}}
+
+            changed = False
+            async for doc in self.collection.find(query):
+                changed |= self._apply(doc)
+            if changed:
+                self._publish()
+
+    async def run(self):
+        while True:
+            try:
+                await self._watch()
+            except Exception as e:
+                if (
+                    isinstance(e, OperationFailure)
+                    and e.code == CHANGE_STREAM_UNSUPPORTED
+                ):
+                    logger.info("Change streams unavailable, polling aggregation rules")
+                    break
+                logger.exception("❌ Rule change stream failed, reloading")
+                await asyncio.sleep(self.poll_interval)
+
+        while True:
+            try:
+                await self._poll()
+            except Exception:
+                logger.exception("❌ Rule polling failed")
+                await asyncio.sleep(self.poll_interval)
+
+
+rule_registry = RuleRegistry(
+    AsyncIOMotorClient(settings.MONGO_URI)[settings.MONGO_DB].aggregation_rules,
+    poll_interval=settings.AGGREGATION_RULES_RELOAD_SECONDS,
+    full_reload_interval=settings.AGGREGATION_RULES_FULL_RELOAD_SECONDS,
+)
@@ -7,6 +7,58 @@ WINDOW_TO_CH_INTERVAL = {
     "1h": (1, "HOUR"),
 }
 
+WINDOW_TO_SECONDS = {
+    window: value * (3600 if unit == "HOUR" else 60)
+    for window, (value, unit) in WINDOW_TO_CH_INTERVAL.items()
+}
+
+METRIC_TO_CH_SQL = {
+    "event_count": "count()",
+    "active_users": "uniqExact(user_id)",
+    # HyperLogLog-backed, ~0.3% relative standard error
+    "active_users_approx": "uniqCombined64(user_id)",
+}
+
+# Distinct-user metrics also store a mergeable state of user_id:
+# metric -> (state column, ClickHouse aggregate function)
+METRIC_STATES = {
+    "active_users": ("users_state", "uniqExact"),
+    "active_users_approx": ("users_sketch", "uniqCombined64"),
+}
+
+# events_fact columns a rule may group by
+GROUPABLE_COLUMNS = {"event_type", "user_id", "event_id"}
+
+# Composite keys: components are joined with the ASCII unit separator into
+# group_key and kept as an array in group_values. A component aggregated
+# away by ROLLUP/CUBE is stored as ALL_MARKER.
+KEY_SEPARATOR_SQL = "'\\x1f'"
+ALL_MARKER = "__all__"
+GROUP_MODES = ("none", "rollup", "cube")
+MAX_CUBE_COLUMNS = 4
+
+# Per-row value of the component named by lambda argument `c`
+_COLUMN_LOOKUP_SQL = "multiIf({}, '')".format(
+    ", ".join(f"c = '{col}', toString({col})" for col in sorted(GROUPABLE_COLUMNS))
+)
+
+
+def group_values_sql(columns: str, mask: str) -> str:
+    """Array(String) of key components for a column-name array and bitmask.
+
+    ``columns`` and ``mask`` are SQL expressions, either literals for a
+    single rule or fields of the per-rule tuple in a shared scan.
+    """
+    return (
+        f"arrayMap((c, i) -> if(bitTest({mask}, i - 1), {_COLUMN_LOOKUP_SQL}, "
+        f"'{ALL_MARKER}'), {columns}, arrayEnumerate({columns}))"
+    )
+
+
+def group_key_sql(values: str) -> str:
+    return f"arrayStringConcat({values}, {KEY_SEPARATOR_SQL})"
+
+
 @dataclass
 class AggregationRule:
     rule_id: str
@@ -14,7 +66,63 @@ class AggregationRule:
     metric: str
     group_by: list[str]
     top_n: int | None = None
+    group_mode: str = "none"
 
     @property
     def ch_interval(self):
         return WINDOW_TO_CH_INTERVAL[self.window_size]
+
+    @property
+    def window_seconds(self) -> int:
+        return WINDOW_TO_SECONDS[self.window_size]
+
+    @property
+    def metric_sql(self) -> str:
+        try:
+            return METRIC_TO_CH_SQL[self.metric]
+        except KeyError:
+            raise ValueError(f"Unsupported metric: {self.metric}") from None
+
+    @property
+    def group_columns(self) -> list[str]:
+        for col in self.group_by:
+            if col not in GROUPABLE_COLUMNS:
+                raise ValueError(f"Unsupported group_by column: {col}")
+        if not self.group_by:
+            raise ValueError("group_by must not be empty")
+        return list(self.group_by)
+
+    @property
+    def group_masks(self) -> list[int]:
+        """Bitmasks of the key components produced per event.
+
+        Bit i set means group_by[i] is part of that combination; ``rollup``
+        yields every prefix, ``cube`` every subset.
+        """
+        n = len(self.group_columns)
+        if self.group_mode == "rollup":
+            return [(1 << k) - 1 for k in range(n, -1, -1)]
+        if self.group_mode == "cube":
+            if n > MAX_CUBE_COLUMNS:
+                raise ValueError(f"cube supports at most {MAX_CUBE_COLUMNS} columns")
+            return list(range((1 << n) - 1, -1, -1))
+        if self.group_mode != "none":
+            raise ValueError(f"Unsupported group_mode: {self.group_mode}")
+        return [(1 << n) - 1]
+
+    @property
+    def group_values_sql(self) -> str:
+        """Key components for this rule; expects a `mask` column in scope."""
+        columns = "[" + ", ".join(f"'{c}'" for c in self.group_columns) + "]"
+        return group_values_sql(columns, "mask")
+
+    @property
+    def masks_sql(self) -> str:
+        return "[" + ", ".join(str(m) for m in self.group_masks) + "]"
+
+    def validate(self):
+        """Raise ValueError if the rule can't be compiled to SQL."""
+        self.metric_sql
+        if self.top_n and self.group_mode != "none":
+            raise ValueError("top_n rules cannot use rollup/cube grouping")
+        self.group_masks
@@ -1,81 +1,134 @@
 import asyncio
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime, timedelta
 from app.core.settings import settings
 from app.aggregation.rules import AggregationRule
+from app.aggregation.registry import rule_registry
+from app.aggregation.backfill import BackfillWorker
 from app.aggregation.engine import AggregationEngine
+from app.aggregation.materialized import MaterializedViewManager
+from app.aggregation.sharding import ShardCoordinator
+from app.aggregation.timer import RuleTimer
 import logging
 import socket
+import time
 import uuid
 
 logger = logging.getLogger(__name__)
 
 
 class AggregationScheduler:
-    LOCK_ID = "aggregation_scheduler_lock"
-    LOCK_TTL_SECONDS = 30
-
     def __init__(self):
         self.engine = AggregationEngine()
+        self.views = MaterializedViewManager()
 
         self.mongo = AsyncIOMotorClient(settings.MONGO_URI)
         self.db = self.mongo[settings.MONGO_DB]
         logger.warning("SCHEDULER USING DB: %s", settings.MONGO_DB)
-        self.rules_col = self.db.aggregation_rules
-        self.lock_col = self.db.aggregation_locks
+        self.registry = rule_registry
 
         self.owner_id = f"{socket.gethostname()}-{uuid.uuid4()}"
-
-    async def acquire_lock(self) -> bool:
-        now = datetime.utcnow()
-        expires_at = now + timedelta(seconds=self.LOCK_TTL_SECONDS)
-
-        res = await self.lock_col.find_one_and_update(
-            {
-                "_id": self.LOCK_ID,
-                "$or": [
-                    {"expires_at": {"$lt": now}},
-                    {"owner_id": self.owner_id},
-                ],
-            },
-            {
-                "$set": {
-                    "expires_at": expires_at,
-                    "owner_id": self.owner_id,
-                    "updated_at": now,
-                }
-            },
-            upsert=True,
-            return_document=True,
+        self.shards = ShardCoordinator(
+            members_col=self.db.aggregation_members,
+            leases_col=self.db.aggregation_leases,
+            owner_id=self.owner_id,
+            shards=settings.AGGREGATION_SHARDS,
+            lease_ttl=settings.AGGREGATION_LEASE_TTL_SECONDS,
+            vnodes=settings.AGGREGATION_RING_VNODES,
+        )
+        self.backfill = BackfillWorker(self.engine, self.owned_rules)
+        self.timer = RuleTimer(
+            refreshes_per_window=settings.AGGREGATION_REFRESHES_PER_WINDOW,
+            min_interval=settings.AGGREGATION_MIN_INTERVAL_SECONDS,
+            max_interval=settings.AGGREGATION_MAX_INTERVAL_SECONDS,
         )
 
-        return res is not None
+    def owned_rules(self) -> list[AggregationRule]:
+        return [
+            r for r in self.registry.active_rules() if self.shards.owns(r.rule_id)
+        ]
 
-    async def release_lock(self):
-        await self.lock_col.update_one(
-            {"_id": self.LOCK_ID, "owner_id": self.owner_id},
-            {"$set": {"expires_at": datetime.utcnow()}},
-        )
+    def scheduled_rules(self) -> list[AggregationRule]:
+        rules = self.owned_rules()
+        if settings.AGGREGATION_MODE in ("materialized", "streaming"):
+            # Views or the consumer aggregate everything but top-N rules
+            return [r for r in rules if r.top_n]
+        return rules
 
-    async def fetch_active_rules(self) -> list[AggregationRule]:
-        rules: list[AggregationRule] = []
-        logger.warning(f"143 - {self.rules_col}", )
+    async def keep_leases(self):
+        interval = settings.AGGREGATION_LEASE_TTL_SECONDS / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.shards.refresh()
+            except Exception:
+                logger.exception("❌ Shard lease renewal failed")
 
-        async for doc in self.rules_col.find({"is_active": True}):
+    async def sync_views(self):
+        while True:
             try:
-                rules.append(
-                    AggregationRule(
-                        rule_id=doc["rule_id"],
-                        window_size=doc["window_size"],
-                        metric=doc["metric"],
-                        group_by=doc["group_by"],
-                        top_n=doc.get("top_n"),
+                # View DDL is cheap and must see every rule to drop stale
+                # views, so shard 0's holder does all of it
+                if 0 in self.shards.owned:
+                    await self.views.sync(self.registry.active_rules())
+            except Exception:
+                logger.exception("❌ Aggregation scheduler failure")
+
+            await asyncio.sleep(settings.AGGREGATION_RULES_RELOAD_SECONDS)
+
+    async def poll(self):
+        """Run each rule when it is due and events_fact has changed since."""
+        synced = None
+        while True:
+            now = time.time()
+            try:
+                # Rules or shard ownership changed since the last sync
+                current = (self.registry.version, frozenset(self.shards.owned))
+                if current != synced:
+                    self.timer.sync(self.scheduled_rules(), now)
+                    synced = current
+                    logger.info(
+                        "⏱️ Scheduling %d of %d active rules",
+                        len(self.timer),
+                        len(self.registry.snapshot),
                     )
+
+                # Rules due within the next moment join this run, so more of
+                # them share a scan instead of each waking up on its own
+                due = self.timer.pop_due(
+                    now + settings.AGGREGATION_MIN_INTERVAL_SECONDS / 2
                 )
-            except KeyError as e:
-                logger.warning("Invalid rule skipped: %s (%s)", doc, e)
+                if due:
+                    await self.run_due(due)
 
-        return rules
+            except Exception:
+                logger.exception("❌ Aggregation scheduler failure")
+
+            wake_at = now + settings.AGGREGATION_RULES_RELOAD_SECONDS
+            next_due = self.timer.next_due()
+            if next_due is not None:
+                wake_at = min(wake_at, next_due)
+            await asyncio.sleep(max(0.05, wake_at - time.time()))
+
+    async def run_due(self, due: list[AggregationRule]):
+        try:
+            # Taken before the run: parts written meanwhile trigger a rerun
+            version = await self.engine.data_version()
+            fresh = [r for r in due if self.timer.changed(r, version)]
+            if fresh:
+                # Rules not due now, or owned by another replica, still
+                # serve as rollup sources through what they stored
+                failed = await self.engine.run_rules(
+                    fresh, sources=self.registry.active_rules()
+                )
+                for rule in fresh:
+                    if rule.rule_id not in failed:
+                        self.timer.mark(rule, version)
+            else:
+                logger.debug("No new parts for %d due rule(s)", len(due))
+        finally:
+            now = time.time()
+            for rule in due:
+                self.timer.schedule(rule, now)
 
     async def run(self):
         logger.info(
@@ -83,24 +136,32 @@ class AggregationScheduler:
             self.owner_id,
         )
 
+        # Leases are renewed on their own cadence so a long aggregation run
+        # can't let them lapse
         while True:
             try:
-                has_lock = await self.acquire_lock()
-                if not has_lock:
-                    await asyncio.sleep(3)
-                    continue
-
-                rules = await self.fetch_active_rules()
-                if not rules:
-                    logger.info("No active aggregation rules")
-
-                for rule in rules:
-                    await self.engine.run_rule(rule)
-
+                await self.shards.refresh()
+                break
             except Exception:
-                logger.exception("❌ Aggregation scheduler failure")
-
-            finally:
-                await self.release_lock()
-
-            await asyncio.sleep(10)
+                logger.exception("❌ Initial shard lease refresh failed, retrying")
+                await asyncio.sleep(settings.AGGREGATION_LEASE_TTL_SECONDS / 3)
+        renewer = asyncio.create_task(self.keep_leases(), name="aggregation-leases")
+        backfill = None
+        if settings.AGGREGATION_MODE == "poll" and settings.BACKFILL_ENABLED:
+            backfill = asyncio.create_task(
+                self.backfill.run(), name="aggregation-backfill"
+            )
+
+        try:
+            await self.registry.wait_loaded()
+            if settings.AGGREGATION_MODE == "materialized":
+                await asyncio.gather(self.sync_views(), self.poll())
+            else:
+                await self.poll()
+
+        finally:
+            tasks = [t for t in (renewer, backfill) if t is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.shards.release()
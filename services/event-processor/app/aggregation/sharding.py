@@ -0,0 +1,168 @@
+import bisect
+import hashlib
+import logging
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+
+def shard_of(rule_id: str, shards: int) -> int:
+    return _hash(rule_id) % shards
+
+
+class HashRing:
+    """Consistent-hash ring of replica ids with virtual nodes.
+
+    Adding or removing a replica only moves the shards adjacent to its
+    points, roughly ``1 / replicas`` of them.
+    """
+
+    def __init__(self, members: list[str], vnodes: int):
+        points = sorted(
+            (_hash(f"{member}#{i}"), member)
+            for member in members
+            for i in range(vnodes)
+        )
+        self._keys = [p[0] for p in points]
+        self._members = [p[1] for p in points]
+
+    def owner(self, shard: int) -> str | None:
+        if not self._keys:
+            return None
+        idx = bisect.bisect(self._keys, _hash(f"shard-{shard}")) % len(self._keys)
+        return self._members[idx]
+
+
+class ShardCoordinator:
+    """Spreads rule shards over live event-processor replicas.
+
+    Each replica heartbeats into ``members_col`` and maps every shard onto
+    the ring of live members. Shards it should own are leased (or renewed),
+    shards that moved to another replica are released, all in a single
+    ``bulk_write`` against ``leases_col``. A shard is only worked on while
+    its lease is held, so during a rebalance the old owner stops before the
+    new one starts.
+    """
+
+    def __init__(
+        self,
+        members_col,
+        leases_col,
+        owner_id: str,
+        shards: int,
+        lease_ttl: int,
+        vnodes: int,
+    ):
+        self.members_col = members_col
+        self.leases_col = leases_col
+        self.owner_id = owner_id
+        self.shards = shards
+        self.lease_ttl = lease_ttl
+        self.vnodes = vnodes
+
+        self.members: list[str] = []
+        self.owned: set[int] = set()
+
+    async def heartbeat(self):
+        now = datetime.utcnow()
+        await self.members_col.update_one(
+            {"_id": self.owner_id},
+            {
+                "$set": {
+                    "expires_at": now + timedelta(seconds=self.lease_ttl),
+                    "updated_at": now,
+                }
+            },
+            upsert=True,
+        )
+
+    async def live_members(self) -> list[str]:
+        cursor = self.members_col.find(
+            {"expires_at": {"$gt": datetime.utcnow()}}, {"_id": 1}
+        )
+        return sorted([doc["_id"] async for doc in cursor])
+
+    async def refresh(self) -> set[int]:
+        """Heartbeat, rebalance and renew leases; returns the shards held."""
+        await self.heartbeat()
+
+        members = await self.live_members()
+        if members != self.members:
+            logger.info("🔀 Aggregation replicas: %s", members)
+            self.members = members
+
+        ring = HashRing(members, self.vnodes)
+        wanted = [s for s in range(self.shards) if ring.owner(s) == self.owner_id]
+        released = self.owned.difference(wanted)
+
+        now = datetime.utcnow()
+        expires_at = now + timedelta(seconds=self.lease_ttl)
+
+        # An acquire that loses to a live lease of another replica turns
+        # into a duplicate-key upsert, reported per operation.
+        ops = [
+            UpdateOne(
+                {
+                    "_id": shard,
+                    "$or": [
+                        {"expires_at": {"$lt": now}},
+                        {"owner_id": self.owner_id},
+                    ],
+                },
+                {
+                    "$set": {
+                        "owner_id": self.owner_id,
+                        "expires_at": expires_at,
+                        "updated_at": now,
+                    }
+                },
+                upsert=True,
+            )
+            for shard in wanted
+        ]
+        ops.extend(
+            UpdateOne(
+                {"_id": shard, "owner_id": self.owner_id},
+                {"$set": {"expires_at": now}},
+            )
+            for shard in released
+        )
+
+        failed: set[int] = set()
+        if ops:
+            try:
+                await self.leases_col.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                if any(err.get("code") != 11000 for err in errors):
+                    raise
+                failed = {wanted[err["index"]] for err in errors}
+
+        owned = set(wanted) - failed
+        if owned != self.owned:
+            logger.info(
+                "📦 Holding %d/%d aggregation shards (%d pending handoff)",
+                len(owned),
+                self.shards,
+                len(failed),
+            )
+        self.owned = owned
+        return owned
+
+    def owns(self, rule_id: str) -> bool:
+        return shard_of(rule_id, self.shards) in self.owned
+
+    async def release(self):
+        """Give up every lease and leave the ring, e.g. on shutdown."""
+        await self.leases_col.update_many(
+            {"owner_id": self.owner_id},
+            {"$set": {"expires_at": datetime.utcnow()}},
+        )
+        await self.members_col.delete_one({"_id": self.owner_id})
+        self.owned = set()
@@ -0,0 +1,97 @@
+from datetime import datetime, timezone
+from app.aggregation.rules import ALL_MARKER, METRIC_STATES, AggregationRule
+from app.columns import EventColumns
+
+PARTIAL_COLUMN_NAMES = [
+    "rule_id",
+    "window_start",
+    "metric",
+    "group_key",
+    "group_values",
+    "value",
+    "user_ids",
+]
+
+KEY_SEPARATOR = "\x1f"
+
+
+class PartialAggregates:
+    """Per-batch aggregates keyed by (rule_id, window start, metric, group values).
+
+    event_count keys hold a counter, distinct-user keys the set of user_ids
+    seen. Each key is flushed as one row, distinct users as an array, and
+    merged into ``events_agg_state`` by ClickHouse, so each batch only
+    contributes its own events.
+    """
+
+    def __init__(self):
+        self.counts: dict[tuple, int] = {}
+        self.users: dict[tuple, set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.counts) + len(self.users)
+
+    def add(self, columns: EventColumns, rule: AggregationRule, epochs: list[int]):
+        window = rule.window_seconds
+        sources = [getattr(columns, col) for col in rule.group_columns]
+        masks = rule.group_masks
+        full_mask = (1 << len(sources)) - 1
+
+        distinct = rule.metric in METRIC_STATES
+        user_ids = columns.user_id
+        counts, users = self.counts, self.users
+
+        for i, epoch in enumerate(epochs):
+            values = tuple(src[i] for src in sources)
+            window_start = epoch - epoch % window
+
+            for mask in masks:
+                if mask == full_mask:
+                    key_values = values
+                else:
+                    key_values = tuple(
+                        v if mask >> bit & 1 else ALL_MARKER
+                        for bit, v in enumerate(values)
+                    )
+                key = (rule.rule_id, window_start, rule.metric, key_values)
+
+                if distinct:
+                    seen = users.get(key)
+                    if seen is None:
+                        seen = users[key] = set()
+                    seen.add(user_ids[i])
+                else:
+                    counts[key] = counts.get(key, 0) + 1
+
+    def as_columns(self) -> list[list]:
+        """Column-oriented rows, one per key."""
+        cols: list[list] = [[] for _ in PARTIAL_COLUMN_NAMES]
+        rule_ids, windows, metrics, keys, values_col, value, user_col = cols
+
+        def append(key: tuple, count: int, user_ids: list[str]):
+            rule_id, window_start, metric, group_values = key
+            rule_ids.append(rule_id)
+            windows.append(datetime.fromtimestamp(window_start, timezone.utc))
+            metrics.append(metric)
+            keys.append(KEY_SEPARATOR.join(group_values))
+            values_col.append(list(group_values))
+            value.append(count)
+            user_col.append(user_ids)
+
+        for key, count in self.counts.items():
+            append(key, count, [])
+        for key, seen in self.users.items():
+            append(key, 0, list(seen))
+        return cols
+
+
+def aggregate(columns: EventColumns, rules: list[AggregationRule]) -> PartialAggregates:
+    """Evaluate ``rules`` over one decoded batch."""
+    partials = PartialAggregates()
+    if not len(columns):
+        return partials
+
+    epochs = [int(ts.timestamp()) for ts in columns.timestamp]
+    for rule in rules:
+        partials.add(columns, rule, epochs)
+    return partials
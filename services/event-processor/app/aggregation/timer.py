@@ -0,0 +1,93 @@
+import heapq
+import itertools
+from app.aggregation.rules import AggregationRule
+
+
+class RuleTimer:
+    """Min-heap of rules keyed by their next due time.
+
+    A rule is due every ``window / refreshes_per_window`` seconds (clamped)
+    and right after each of its windows closes, so a 1m rule refreshes
+    often while a 1h rule wakes up a handful of times per hour. Entries of
+    removed or rescheduled rules are dropped lazily when they surface.
+    """
+
+    def __init__(
+        self,
+        refreshes_per_window: int,
+        min_interval: float,
+        max_interval: float,
+        close_delay: float = 1.0,
+    ):
+        self.refreshes_per_window = refreshes_per_window
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.close_delay = close_delay
+
+        self._heap: list[tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._rules: dict[str, AggregationRule] = {}
+        self._due: dict[str, float] = {}
+        # data version each rule last ran against
+        self._seen: dict[str, object] = {}
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def interval(self, rule: AggregationRule) -> float:
+        return min(
+            self.max_interval,
+            max(self.min_interval, rule.window_seconds / self.refreshes_per_window),
+        )
+
+    def schedule(self, rule: AggregationRule, now: float, at: float | None = None):
+        if at is None:
+            window = rule.window_seconds
+            window_close = (now // window + 1) * window + self.close_delay
+            at = min(now + self.interval(rule), window_close)
+
+        self._due[rule.rule_id] = at
+        heapq.heappush(self._heap, (at, next(self._seq), rule.rule_id))
+
+    def sync(self, rules: list[AggregationRule], now: float):
+        """Track exactly ``rules``; new or changed definitions are due now."""
+        wanted = {rule.rule_id: rule for rule in rules}
+
+        for rule_id in self._rules.keys() - wanted.keys():
+            del self._rules[rule_id]
+            self._due.pop(rule_id, None)
+            self._seen.pop(rule_id, None)
+
+        for rule_id, rule in wanted.items():
+            if self._rules.get(rule_id) != rule:
+                self._rules[rule_id] = rule
+                self._seen.pop(rule_id, None)
+                self.schedule(rule, now, at=now)
+
+    def next_due(self) -> float | None:
+        self._discard_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> list[AggregationRule]:
+        due = []
+        while True:
+            self._discard_stale()
+            if not self._heap or self._heap[0][0] > now:
+                return due
+            _, _, rule_id = heapq.heappop(self._heap)
+            del self._due[rule_id]
+            due.append(self._rules[rule_id])
+
+    def _discard_stale(self):
+        while self._heap:
+            at, _, rule_id = self._heap[0]
+            if self._due.get(rule_id) == at:
+                return
+            heapq.heappop(self._heap)
+
+    def changed(self, rule: AggregationRule, version) -> bool:
+        return self._seen.get(rule.rule_id) != version
+
+    def mark(self, rule: AggregationRule, version):
+        if rule.rule_id in self._rules:
+            self._seen[rule.rule_id] = version
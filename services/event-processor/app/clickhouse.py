@@ -1,5 +1,7 @@
+import asyncio
 import clickhouse_connect
-from datetime import datetime
+from app.columns import COLUMN_NAMES, EventColumns
+from app.aggregation.streaming import PARTIAL_COLUMN_NAMES, PartialAggregates
 from app.core.settings import settings
 
 
@@ -14,37 +16,73 @@ class ClickHouseClient:
                 port=settings.CLICKHOUSE_PORT,
                 username=settings.CLICKHOUSE_USER,
                 password=settings.CLICKHOUSE_PASSWORD,
-                database="analytics"
+                database="analytics",
+                # Sinks and aggregation share this client concurrently;
+                # a per-client session would serialize them
+                autogenerate_session_id=False,
             )
         return self._client
 
-    async def insert_events(self, events: list[dict]):
-        if not events:
-            return
-
+    async def _insert(
+        self,
+        table: str,
+        data: list[list],
+        column_names: list[str],
+        insert_settings: dict,
+    ):
         client = await self.get_client()
-
-        rows = []
-        for e in events:
-            ts = e["timestamp"]
-            if isinstance(ts, str):
-                ts = datetime.fromisoformat(ts.replace("Z", "+00:00"))
-
-            rows.append([
-                str(e["event_id"]),
-                str(e["user_id"]),
-                str(e["event_type"]),
-                ts
-            ])
-
         try:
             await client.insert(
-                "events_fact",
-                rows,
-                column_names=["event_id", "user_id", "event_type", "timestamp"]
+                table,
+                data,
+                column_names=column_names,
+                column_oriented=True,
+                settings=insert_settings,
             )
-        except Exception as e:
-            print(f"❌ ClickHouse Async Insert Error: {e}")
+        except (Exception, asyncio.CancelledError):
+            # Reconnect on the next attempt. A sink timeout cancels the
+            # insert, and a client stuck mid-request must not be reused.
             self._client = None
+            raise
+
+    async def insert_columns(self, columns: EventColumns, dedup_token: str | None = None):
+        if not len(columns):
+            return
+
+        insert_settings = {}
+        if dedup_token:
+            insert_settings = {
+                "insert_deduplicate": 1,
+                "insert_deduplication_token": dedup_token,
+            }
+
+        await self._insert(
+            "events_fact", columns.as_columns(), COLUMN_NAMES, insert_settings
+        )
+
+    async def insert_partials(
+        self, partials: PartialAggregates, dedup_token: str | None = None
+    ):
+        """Feed partial aggregates through events_agg_partial into events_agg_state."""
+        if not len(partials):
+            return
+
+        insert_settings = {}
+        if dedup_token:
+            # The Null table keeps nothing; deduplication happens where the
+            # view writes, in events_agg_state
+            insert_settings = {
+                "insert_deduplicate": 1,
+                "insert_deduplication_token": dedup_token,
+                "deduplicate_blocks_in_dependent_materialized_views": 1,
+            }
+
+        await self._insert(
+            "events_agg_partial",
+            partials.as_columns(),
+            PARTIAL_COLUMN_NAMES,
+            insert_settings,
+        )
+
 
 clickhouse_client = ClickHouseClient()
@@ -0,0 +1,70 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+COLUMN_NAMES = ["event_id", "user_id", "event_type", "timestamp"]
+
+
+def parse_timestamp(ts) -> datetime | None:
+    """Parse an ISO 8601 timestamp once; naive values are taken as UTC."""
+    if not isinstance(ts, str) or not ts:
+        return None
+
+    try:
+        # 3.11's C parser accepts both "Z" and "+00:00" directly and maps
+        # them to timezone.utc, so the common case needs no string copies.
+        parsed = datetime.fromisoformat(ts)
+    except ValueError:
+        return None
+
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+@dataclass
+class EventColumns:
+    """Column-oriented buffer of the fields stored in events_fact."""
+
+    event_id: list[str] = field(default_factory=list)
+    user_id: list[str] = field(default_factory=list)
+    event_type: list[str] = field(default_factory=list)
+    timestamp: list[datetime] = field(default_factory=list)
+    skipped: int = 0
+
+    def __len__(self) -> int:
+        return len(self.event_id)
+
+    def append_event(self, event: dict) -> bool:
+        """Add one decoded event; returns False if it can't go to ClickHouse."""
+        event_id = event.get("event_id")
+        user_id = event.get("user_id")
+        event_type = event.get("event_type")
+        ts = parse_timestamp(event.get("timestamp"))
+
+        if ts is None or event_id is None or user_id is None or event_type is None:
+            self.skipped += 1
+            return False
+
+        self.append_row(
+            event_id if type(event_id) is str else str(event_id),
+            user_id if type(user_id) is str else str(user_id),
+            event_type if type(event_type) is str else str(event_type),
+            ts,
+        )
+        return True
+
+    def append_row(self, event_id: str, user_id: str, event_type: str, ts: datetime):
+        """Add already validated fields, e.g. from a binary-encoded record."""
+        self.event_id.append(event_id)
+        self.user_id.append(user_id)
+        self.event_type.append(event_type)
+        self.timestamp.append(ts)
+
+    def minutes_before(self, cutoff: datetime) -> set[int]:
+        """Epoch minutes holding events older than ``cutoff``."""
+        if not self.timestamp or min(self.timestamp) >= cutoff:
+            return set()
+        return {int(ts.timestamp()) // 60 for ts in self.timestamp if ts < cutoff}
+
+    def as_columns(self) -> list[list]:
+        return [self.event_id, self.user_id, self.event_type, self.timestamp]
@@ -1,23 +1,199 @@
-import json
+import asyncio
+import hashlib
 import logging
-from datetime import datetime
-from aiokafka import AIOKafkaConsumer
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener, TopicPartition
 from aiokafka.errors import KafkaError
+from bson.raw_bson import RawBSONDocument
 from app.core.settings import settings
 from app.mongo import mongo_client
 from app.clickhouse import clickhouse_client
+from app.columns import EventColumns
+from app.aggregation.backfill import backfill_queue
+from app.aggregation.engine import AggregationEngine
+from app.aggregation.registry import rule_registry
+from app.aggregation.rules import AggregationRule
+from app.decode import ENCODING_HEADER, DecodedBatch, decode_chunks
+from app.dlq import DeadLetter, ErrorCounter, make_dead_letter_sink
+from app.ledger import insert_ledger
 
 logger = logging.getLogger(__name__)
 
 
+@dataclass
+class Chunk:
+    """One partition's offsets [start, end), inserted under their own token."""
+
+    tp: TopicPartition
+    start: int
+    end: int
+    # the chunk's slice of the batch's values
+    first: int
+    last: int
+    decoded: DecodedBatch | None = None
+
+    @property
+    def dedup_token(self) -> str:
+        key = f"{self.tp.topic}:{self.tp.partition}:{self.start}-{self.end}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+@dataclass
+class ConsumedBatch:
+    # fetched records per partition, laid out in chunks by seal()
+    records: dict[TopicPartition, list] = field(default_factory=dict)
+    size: int = 0
+    nbytes: int = 0
+    # raw Kafka values, decoded chunk by chunk by the decode stage
+    values: list[bytes | None] = field(default_factory=list)
+    # event-encoding header per value, None for JSON
+    encodings: list[bytes | None] = field(default_factory=list)
+    # (partition, offset) of each raw value, to address dead letters
+    positions: list[tuple[TopicPartition, int]] = field(default_factory=list)
+    chunks: list[Chunk] = field(default_factory=list)
+    events: list[RawBSONDocument] = field(default_factory=list)
+    dead_letters: list[DeadLetter] = field(default_factory=list)
+    # next offset to commit, per partition
+    offsets: dict[TopicPartition, int] = field(default_factory=dict)
+
+    def add(self, tp: TopicPartition, messages: list):
+        self.records.setdefault(tp, []).extend(messages)
+        self.offsets[tp] = messages[-1].offset + 1
+        self.size += len(messages)
+        self.nbytes += sum(len(msg.value or b"") for msg in messages)
+
+    def drop(self, tp: TopicPartition):
+        """Forget a partition whose position was reset mid-batch."""
+        messages = self.records.pop(tp, [])
+        self.offsets.pop(tp, None)
+        self.size -= len(messages)
+        self.nbytes -= sum(len(msg.value or b"") for msg in messages)
+
+    def inside(self, cuts: dict[TopicPartition, list[int]]) -> bool:
+        """Whether a partition stops short of a chunk end still to reproduce."""
+        return any(
+            tp in self.offsets and self.offsets[tp] < ends[-1]
+            and self.offsets[tp] not in ends
+            for tp, ends in cuts.items()
+        )
+
+    def seal(self, cuts: dict[TopicPartition, list[int]]):
+        """Lay the records out as one chunk per partition, split at ``cuts``."""
+        for tp, messages in self.records.items():
+            ends = iter(cuts.get(tp, ()))
+            cut = next(ends, None)
+            chunk = None
+            for msg in messages:
+                while cut is not None and msg.offset >= cut:
+                    if chunk is not None:
+                        self.chunks.append(chunk)
+                        chunk = None
+                    cut = next(ends, None)
+                if chunk is None:
+                    first = len(self.values)
+                    chunk = Chunk(tp, msg.offset, msg.offset, first, first)
+                self.values.append(msg.value)
+                self.encodings.append(_encoding(msg.headers))
+                self.positions.append((tp, msg.offset))
+                chunk.end = msg.offset + 1
+                chunk.last = len(self.values)
+            if chunk is not None:
+                self.chunks.append(chunk)
+        self.records = {}
+
+    def ledger(self) -> dict[TopicPartition, tuple[int, list[int]]]:
+        """First offset and chunk ends per partition, for the insert ledger."""
+        entries: dict[TopicPartition, tuple[int, list[int]]] = {}
+        for chunk in self.chunks:
+            entries.setdefault(chunk.tp, (chunk.start, []))[1].append(chunk.end)
+        return entries
+
+
+async def _with_retry(name: str, write, timeout: float, max_retries: int):
+    """Run one sink write with its own timeout and retry budget."""
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return await asyncio.wait_for(write(), timeout=timeout)
+        except Exception as e:
+            if attempt >= max_retries:
+                raise
+            logger.warning(
+                "%s sink write failed (attempt %d/%d): %r",
+                name,
+                attempt,
+                max_retries,
+                e,
+            )
+            await asyncio.sleep(settings.SINK_RETRY_BACKOFF * attempt)
+
+
+def _encoding(headers) -> bytes | None:
+    for key, value in headers:
+        if key == ENCODING_HEADER:
+            return value
+    return None
+
+
+def _make_executor() -> Executor | None:
+    workers = settings.DECODE_WORKERS or os.cpu_count() or 1
+    if settings.DECODE_MODE == "process":
+        # spawn: a forked child would inherit the loop's sockets and threads
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    if settings.DECODE_MODE == "thread":
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
+    return None
+
+
+class PartitionRebalanceListener(ConsumerRebalanceListener):
+    """Starts and drains per-partition pipelines as the group rebalances."""
+
+    def __init__(self, consumer: "EventConsumer"):
+        self.consumer = consumer
+
+    async def on_partitions_revoked(self, revoked):
+        # Runs before the rejoin, so draining pipelines can still commit
+        await self.consumer.stop_pipelines(revoked)
+
+    async def on_partitions_assigned(self, assigned):
+        self.consumer.start_pipelines(assigned)
+
+
+@dataclass
+class Pipeline:
+    task: asyncio.Task
+    stop: asyncio.Event
+
+
 class EventConsumer:
     def __init__(self):
         self.consumer: AIOKafkaConsumer | None = None
         self._running = False
+        self._executor: Executor | None = None
+
+        self.engine = AggregationEngine()
+        self.dead_letters = make_dead_letter_sink()
+        self.errors = ErrorCounter(settings.ERROR_LOG_INTERVAL)
+
+        # CONSUMER_MODE=partition: one pipeline per assigned partition
+        self._pipelines: dict[TopicPartition, Pipeline] = {}
+        self._failure: asyncio.Future | None = None
 
     async def start(self):
+        # Partitions can be assigned, and their pipelines fail, as soon as
+        # the consumer is subscribed, before consume() is awaited
+        self._failure = asyncio.get_running_loop().create_future()
+
         self.consumer = AIOKafkaConsumer(
-            settings.KAFKA_TOPIC,
             bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS,
             group_id=settings.KAFKA_GROUP_ID,
 
@@ -31,6 +207,15 @@ class EventConsumer:
         )
 
         await self.consumer.start()
+        listener = (
+            PartitionRebalanceListener(self)
+            if settings.CONSUMER_MODE == "partition"
+            else None
+        )
+        self.consumer.subscribe([settings.KAFKA_TOPIC], listener=listener)
+        self._executor = _make_executor()
+        if self.dead_letters:
+            await self.dead_letters.start()
         self._running = True
         logger.info("✅ Kafka consumer started")
 
@@ -39,86 +224,395 @@ class EventConsumer:
         if self.consumer:
             await self.consumer.stop()
             logger.info("🛑 Kafka consumer stopped")
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self.dead_letters:
+            await self.dead_letters.stop()
 
     async def consume(self):
-        assert self.consumer is not None
+        assert self.consumer is not None and self._failure is not None
 
-        buffer: list[dict] = []
+        if settings.CONSUMER_MODE != "partition":
+            await self._run_pipeline(())
+            return
 
-        async for msg in self.consumer:
-            try:
-                event = self._parse_message(msg.value)
+        # Pipelines come and go with rebalances; the first one to fail
+        # takes the consumer down like the shared pipeline would.
+        try:
+            await self._failure
+        finally:
+            await self.stop_pipelines(list(self._pipelines))
 
-                if event is None:
-                    await self.consumer.commit()
-                    continue
+    def start_pipelines(self, partitions):
+        for tp in partitions:
+            if tp in self._pipelines:
+                continue
+            stop = asyncio.Event()
+            task = asyncio.create_task(
+                self._run_pipeline((tp,), stop),
+                name=f"kafka-pipeline-{tp.partition}",
+            )
+            task.add_done_callback(self._pipeline_done)
+            self._pipelines[tp] = Pipeline(task, stop)
 
-                buffer.append(event)
+        logger.info(
+            "🧵 Consuming %d partition(s): %s",
+            len(self._pipelines),
+            sorted(tp.partition for tp in self._pipelines),
+        )
 
-                if len(buffer) >= settings.BATCH_SIZE:
-                    await self._handle_batch(buffer)
-                    buffer.clear()
-                    await self.consumer.commit()
+    def _pipeline_done(self, task: asyncio.Task):
+        if task.cancelled() or task.exception() is None:
+            return
+        if not self._failure.done():
+            self._failure.set_exception(task.exception())
 
-            except Exception:
-                logger.exception("💥 Unexpected consumer error")
-                break
+    async def stop_pipelines(self, partitions):
+        """Flush and commit what revoked partitions already fetched."""
+        stopping = [
+            self._pipelines.pop(tp) for tp in partitions if tp in self._pipelines
+        ]
+        if not stopping:
+            return
 
-    @staticmethod
-    def _parse_message(raw: bytes) -> dict | None:
-        if not raw:
-            logger.warning("⚠️ Empty Kafka message skipped")
-            return None
+        for pipeline in stopping:
+            pipeline.stop.set()
+
+        tasks = [p.task for p in stopping]
+        _, pending = await asyncio.wait(
+            tasks, timeout=settings.CONSUMER_DRAIN_TIMEOUT
+        )
+        for task in pending:
+            # Whatever did not make it is re-read by the next owner
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        logger.info("🧵 Released %d partition(s)", len(stopping))
+
+    async def _run_pipeline(
+        self,
+        partitions: tuple[TopicPartition, ...],
+        stop: asyncio.Event | None = None,
+    ):
+        """Fetch, decode and sink concurrently.
+
+        At most DECODE_MAX_IN_FLIGHT batches are being decoded or waiting
+        for the sink, in fetch order, so commits stay in offset order. With
+        ``partitions`` only those are fetched and committed.
+        """
+        # None marks the end of a stopped pipeline
+        batches: asyncio.Queue[tuple[ConsumedBatch, asyncio.Future] | None] = (
+            asyncio.Queue()
+        )
+        # Taken before a batch is submitted, released once it is committed
+        in_flight = asyncio.Semaphore(max(1, settings.DECODE_MAX_IN_FLIGHT))
+
+        fetcher = asyncio.create_task(
+            self._fetch(batches, in_flight, partitions, stop or asyncio.Event()),
+            name="kafka-fetch",
+        )
+        sinker = asyncio.create_task(
+            self._sink(batches, in_flight), name="kafka-sink"
+        )
 
         try:
-            obj = json.loads(raw.decode("utf-8"))
-            if not isinstance(obj, dict):
-                logger.warning("⚠️ Non-dict JSON skipped: %r", obj)
-                return None
-            return obj
-        except json.JSONDecodeError:
-            logger.error("❌ Invalid JSON skipped")
-            return None
+            done, _ = await asyncio.wait(
+                [fetcher, sinker],
+                return_when=asyncio.FIRST_EXCEPTION,
+            )
+            for task in done:
+                if task.exception():
+                    # Uncommitted offsets are replayed after the restart
+                    logger.error(
+                        "💥 Unexpected consumer error",
+                        exc_info=task.exception(),
+                    )
+                    raise task.exception()
+        finally:
+            fetcher.cancel()
+            sinker.cancel()
+            await asyncio.gather(fetcher, sinker, return_exceptions=True)
 
-    async def _handle_batch(self, events: list[dict]):
+    async def _fetch(
+        self,
+        batches: asyncio.Queue,
+        in_flight: asyncio.Semaphore,
+        partitions: tuple[TopicPartition, ...],
+        stop: asyncio.Event,
+    ):
+        linger = settings.BATCH_LINGER_MS / 1000
 
-        valid_events = [e for e in events if isinstance(e, dict)]
+        batch = ConsumedBatch()
+        first_at: float | None = None
+        # Next offset per partition; any other means it was reset to the
+        # committed offset, where an earlier run may have inserted chunks
+        expected: dict[TopicPartition, int] = {}
+        cuts: dict[TopicPartition, list[int]] = {}
 
-        if not valid_events:
-            logger.warning("⚠️ Empty valid batch, skipping")
-            return
+        while self._running and not stop.is_set():
+            if first_at is None:
+                timeout_ms = settings.BATCH_LINGER_MS
+            else:
+                remaining = first_at + linger - time.monotonic()
+                timeout_ms = max(0, int(remaining * 1000))
 
-        logger.info("📦 Processing batch: %d events", len(valid_events))
+            records = await self.consumer.getmany(
+                *partitions,
+                timeout_ms=timeout_ms,
+                max_records=max(1, settings.BATCH_SIZE - batch.size),
+            )
 
-        await mongo_client.insert_many(valid_events)
+            for tp, messages in records.items():
+                if not messages:
+                    continue
+                if expected.get(tp) != messages[0].offset:
+                    batch.drop(tp)
+                    cuts.pop(tp, None)
+                    pending = await insert_ledger.pending(tp)
+                    if pending and pending[0] == messages[0].offset:
+                        cuts[tp] = pending[1]
+                expected[tp] = messages[-1].offset + 1
+                batch.add(tp, messages)
 
-        # 2️⃣ ClickHouse
-        ch_events = []
-        for e in valid_events:
-            ts = self._parse_timestamp(e.get("timestamp"))
-            if not ts:
+            if not batch.offsets:
                 continue
 
-            ch_events.append({
-                **e,
-                "timestamp": ts,
-            })
+            if first_at is None:
+                first_at = time.monotonic()
+
+            if (
+                batch.size >= settings.BATCH_SIZE
+                or batch.nbytes >= settings.BATCH_MAX_BYTES
+                or time.monotonic() - first_at >= linger
+            ) and not batch.inside(cuts):
+                await self._submit(batch, cuts, batches, in_flight)
+                batch = ConsumedBatch()
+                first_at = None
+
+        # Stopping: hand over the partial batch, then tell the sink to finish.
+        # One that ends inside a recorded chunk is left to the next owner.
+        if batch.offsets and not batch.inside(cuts):
+            await self._submit(batch, cuts, batches, in_flight)
+        await batches.put(None)
+
+    async def _submit(
+        self,
+        batch: ConsumedBatch,
+        cuts: dict[TopicPartition, list[int]],
+        batches: asyncio.Queue,
+        in_flight: asyncio.Semaphore,
+    ):
+        batch.seal(cuts)
+        for tp, end in batch.offsets.items():
+            if tp in cuts and end >= cuts[tp][-1]:
+                # Every recorded chunk of the partition is reproduced
+                del cuts[tp]
+
+        # Blocks while DECODE_MAX_IN_FLIGHT batches are outstanding
+        await in_flight.acquire()
+        await batches.put((batch, await self._decode(batch)))
+
+    async def _decode(self, batch: ConsumedBatch) -> asyncio.Future:
+        rules = None
+        if settings.AGGREGATION_MODE == "streaming":
+            await rule_registry.wait_loaded(
+                settings.AGGREGATION_RULES_LOAD_TIMEOUT_SECONDS
+            )
+            rules = self._streaming_rules()
+
+        bounds = [chunk.last for chunk in batch.chunks]
+        if self._executor is None:
+            decoding = asyncio.get_running_loop().create_future()
+            decoding.set_result(
+                decode_chunks(batch.values, batch.encodings, bounds, rules)
+            )
+            return decoding
+
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor,
+            decode_chunks,
+            batch.values,
+            batch.encodings,
+            bounds,
+            rules,
+        )
+
+    async def _sink(self, batches: asyncio.Queue, in_flight: asyncio.Semaphore):
+        while True:
+            item = await batches.get()
+            if item is None:
+                return
+            try:
+                await self._sink_batch(*item)
+            finally:
+                in_flight.release()
+
+    async def _sink_batch(self, batch: ConsumedBatch, decoding: asyncio.Future):
+        parts: list[DecodedBatch] = await decoding
+        for chunk, decoded in zip(batch.chunks, parts):
+            chunk.decoded = decoded
+            # Already encoded, Mongo sends them as they are
+            batch.events.extend(RawBSONDocument(doc) for doc in decoded.documents)
+
+            for index, reason in decoded.rejected:
+                tp, offset = batch.positions[index]
+                batch.dead_letters.append(
+                    DeadLetter(
+                        tp.topic,
+                        tp.partition,
+                        offset,
+                        reason,
+                        batch.values[index],
+                        batch.encodings[index],
+                    )
+                )
+                self.errors.add(reason)
+        batch.values = []
+        batch.encodings = []
+        batch.positions = []
+
+        if batch.events or batch.dead_letters:
+            await self._handle_batch(batch)
+
+        # Dead letters ride along in the same commit
+        await self.consumer.commit(batch.offsets)
+        self.errors.maybe_log()
+
+    async def _handle_batch(self, batch: ConsumedBatch):
+        events = batch.events
+        chunks = batch.chunks
 
-        if ch_events:
-            await clickhouse_client.insert_events(ch_events)
+        logger.info(
+            "📦 Processing batch: %d events, %d dead letters",
+            len(events),
+            len(batch.dead_letters),
+        )
+
+        writes = []
+        if batch.dead_letters and self.dead_letters:
+            writes.append(
+                _with_retry(
+                    "dlq",
+                    lambda: self.dead_letters.send(batch.dead_letters),
+                    timeout=settings.DLQ_SINK_TIMEOUT,
+                    max_retries=settings.DLQ_SINK_MAX_RETRIES,
+                )
+            )
+
+        # Where this batch cuts each partition, so a replay of it cuts the
+        # same chunks and resends the same tokens
+        await _with_retry(
+            "ledger",
+            lambda: insert_ledger.record(batch.ledger()),
+            timeout=settings.MONGO_SINK_TIMEOUT,
+            max_retries=settings.MONGO_SINK_MAX_RETRIES,
+        )
+
+        if settings.AGGREGATION_MODE == "streaming":
+            # Partial aggregates share the batch's commit: they land exactly
+            # when its events do, and a replay re-sends the same tokens
+            writes.append(
+                _with_retry(
+                    "aggregates",
+                    lambda: asyncio.gather(
+                        *(
+                            clickhouse_client.insert_partials(
+                                c.decoded.partials, dedup_token=c.dedup_token
+                            )
+                            for c in chunks
+                        )
+                    ),
+                    timeout=settings.CLICKHOUSE_SINK_TIMEOUT,
+                    max_retries=settings.CLICKHOUSE_SINK_MAX_RETRIES,
+                )
+            )
+
+        # Every sink must acknowledge before the batch offsets are committed
+        await asyncio.gather(
+            *writes,
+            _with_retry(
+                "mongo",
+                lambda: mongo_client.insert_many(events),
+                timeout=settings.MONGO_SINK_TIMEOUT,
+                max_retries=settings.MONGO_SINK_MAX_RETRIES,
+            ),
+            _with_retry(
+                "clickhouse",
+                # One insert per chunk, same token on every attempt and
+                # replay: one that actually landed is dropped by ClickHouse
+                # instead of doubled.
+                lambda: asyncio.gather(
+                    *(
+                        clickhouse_client.insert_columns(
+                            c.decoded.columns, dedup_token=c.dedup_token
+                        )
+                        for c in chunks
+                    )
+                ),
+                timeout=settings.CLICKHOUSE_SINK_TIMEOUT,
+                max_retries=settings.CLICKHOUSE_SINK_MAX_RETRIES,
+            ),
+        )
+
+        # Only once the rows are in events_fact, and before the commit, so a
+        # crash in between replays the batch instead of losing the request
+        await self._queue_backfill([c.decoded.columns for c in chunks])
 
     @staticmethod
-    def _parse_timestamp(ts: str | None) -> datetime | None:
-        if not ts:
-            logger.warning("⚠️ Missing timestamp")
-            return None
+    def _streaming_rules() -> list[AggregationRule]:
+        rules = []
+        for rule in rule_registry.active_rules():
+            if rule.top_n:
+                # Per-batch partials can't tell the top keys; the scheduler
+                # computes these from events_fact into events_topn
+                continue
+            try:
+                rule.validate()
+            except ValueError:
+                continue
+            rules.append(rule)
+        return rules
 
-        try:
-            # ISO 8601 → datetime
-            return datetime.fromisoformat(ts.replace("Z", "+00:00"))
-        except Exception:
-            logger.warning("⚠️ Invalid timestamp skipped: %s", ts)
-            return None
+    async def _queue_backfill(self, columns: list[EventColumns]):
+        """Queue windows that got events too old for the scheduler to revisit."""
+        if settings.AGGREGATION_MODE != "poll" or not settings.BACKFILL_ENABLED:
+            return
+
+        # Cheap pre-check: no scan resumes later than now - lateness
+        cutoff = datetime.now(timezone.utc) - timedelta(
+            seconds=settings.AGGREGATION_LATENESS_SECONDS
+        )
+        minutes = set().union(*(c.minutes_before(cutoff) for c in columns))
+        if not minutes:
+            return
+
+        # Fails the batch instead of stalling the sink if rules never load
+        await rule_registry.wait_loaded(
+            settings.AGGREGATION_RULES_LOAD_TIMEOUT_SECONDS
+        )
+        rules = rule_registry.active_rules()
+        # While the consumer lags, the scans trail the events it inserts and
+        # cover them; only windows behind where they resume need a backfill
+        floors = await _with_retry(
+            "backfill",
+            lambda: self.engine.scan_floors(rules),
+            timeout=settings.CLICKHOUSE_SINK_TIMEOUT,
+            max_retries=settings.CLICKHOUSE_SINK_MAX_RETRIES,
+        )
+        queued = await _with_retry(
+            "backfill",
+            lambda: backfill_queue.enqueue_late(rules, minutes, floors),
+            timeout=settings.MONGO_SINK_TIMEOUT,
+            max_retries=settings.MONGO_SINK_MAX_RETRIES,
+        )
+        if not queued:
+            return
+        logger.info(
+            "⏪ Late events in %d minute(s), %d window(s) queued for backfill",
+            len(minutes),
+            queued,
+        )
 
 
 event_consumer = EventConsumer()
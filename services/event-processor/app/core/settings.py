@@ -17,6 +17,78 @@ class Settings(BaseSettings):
 
     # Processing
     BATCH_SIZE: int = 1000
+    BATCH_MAX_BYTES: int = 4 * 1024 * 1024
+    BATCH_LINGER_MS: int = 1000
+
+    # "shared": one pipeline over all assigned partitions
+    # "partition": one pipeline per partition, each committing on its own
+    CONSUMER_MODE: str = "shared"
+    # Revoked partitions get this long to flush and commit in-flight batches
+    CONSUMER_DRAIN_TIMEOUT: float = 20.0
+
+    # Decode stage: "inline" on the event loop, "thread" or "process" pool.
+    # DECODE_WORKERS=0 uses every core.
+    DECODE_MODE: str = "process"
+    DECODE_WORKERS: int = 0
+    # Batches submitted for decoding and not yet committed, at most
+    DECODE_MAX_IN_FLIGHT: int = 4
+
+    # Sinks
+    SINK_RETRY_BACKOFF: float = 0.5
+    MONGO_SINK_TIMEOUT: float = 30.0
+    MONGO_SINK_MAX_RETRIES: int = 3
+    CLICKHOUSE_SINK_TIMEOUT: float = 30.0
+    CLICKHOUSE_SINK_MAX_RETRIES: int = 8
+
+    # Undecodable or invalid records: "kafka" (DLQ_TOPIC), "file" or "off".
+    # They are committed with their batch either way.
+    DLQ_MODE: str = "kafka"
+    DLQ_TOPIC: str = "events_raw.dlq"
+    DLQ_FILE: str = "/var/lib/event-processor/dlq.jsonl"
+    DLQ_SINK_TIMEOUT: float = 30.0
+    DLQ_SINK_MAX_RETRIES: int = 5
+    # Rejected-record summaries are logged at most this often
+    ERROR_LOG_INTERVAL: float = 10.0
+
+    # Aggregation
+    # "poll": scheduler re-runs INSERT ... SELECT per rule
+    # "materialized": one ClickHouse materialized view per rule
+    # "streaming": the consumer aggregates each batch and flushes partial
+    #   aggregates into events_agg_state with the batch commit
+    AGGREGATION_MODE: str = "poll"
+    AGGREGATION_LATENESS_SECONDS: int = 300
+    # Materialized mode: a new view takes rows inserted from this long after
+    # its creation on; the backfill runs once twice that has passed
+    AGGREGATION_VIEW_CUTOFF_SECONDS: float = 30.0
+    # Shared scans: rules per query, and how far apart their resume points
+    # may be before they are split into separate scans
+    AGGREGATION_MAX_RULES_PER_SCAN: int = 32
+    AGGREGATION_MAX_SCAN_SPREAD_SECONDS: int = 3600
+    # Replicas split rules by consistent hashing over this many leased shards
+    AGGREGATION_SHARDS: int = 256
+    AGGREGATION_RING_VNODES: int = 64
+    AGGREGATION_LEASE_TTL_SECONDS: int = 30
+    # Aggregation queries a replica runs at once
+    AGGREGATION_CONCURRENCY: int = 4
+    # Poll mode re-runs a rule this many times per window (clamped below),
+    # plus once as each window closes, and only if events_fact changed
+    AGGREGATION_REFRESHES_PER_WINDOW: int = 6
+    AGGREGATION_MIN_INTERVAL_SECONDS: float = 5.0
+    AGGREGATION_MAX_INTERVAL_SECONDS: float = 300.0
+    # Rule registry: polling cadence when Mongo has no change streams,
+    # plus a periodic full reload that also catches hard deletes
+    AGGREGATION_RULES_RELOAD_SECONDS: float = 10.0
+    AGGREGATION_RULES_FULL_RELOAD_SECONDS: float = 300.0
+    # How long a consumer batch waits for the first rule load before failing
+    AGGREGATION_RULES_LOAD_TIMEOUT_SECONDS: float = 60.0
+
+    # Late-event backfill (poll mode): events behind where a rule's scans
+    # resume queue their windows for targeted recomputation
+    BACKFILL_ENABLED: bool = True
+    BACKFILL_CONCURRENCY: int = 2
+    BACKFILL_ROWS_PER_SECOND: float = 2_000_000
+    BACKFILL_BATCH_SIZE: int = 100
+    BACKFILL_IDLE_SECONDS: float = 5.0
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -0,0 +1,194 @@
+"""Decode stage: raw Kafka values -> BSON documents + column buffers.
+
+Everything here is top-level and picklable so it can run inline, in a
+thread or in a worker process.
+
+Values are JSON unless their ``event-encoding`` header says otherwise.
+binary-v1 (written by the ingestion-api, see its app.core.codec) is
+little-endian:
+
+    u8 version (0x01) | i64 epoch microseconds (UTC)
+    | u16 length + UTF-8 event_id | same for user_id | same for event_type
+    | payload as JSON, to the end of the value (empty when there is none)
+"""
+import json
+import struct
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+import bson
+from bson.errors import BSONError
+from app.aggregation.rules import AggregationRule
+from app.aggregation.streaming import PartialAggregates, aggregate
+from app.columns import EventColumns
+
+ENCODING_HEADER = "event-encoding"
+ENCODING_BINARY_V1 = b"binary-v1"
+
+BINARY_V1 = 0x01
+BINARY_HEADER = struct.Struct("<Bq")
+BINARY_LENGTH = struct.Struct("<H")
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Why a record was dropped during decoding
+REJECT_EMPTY = "empty"
+REJECT_INVALID_JSON = "invalid_json"
+REJECT_NOT_OBJECT = "not_object"
+# valid JSON object without a usable event_id/user_id/event_type/timestamp
+REJECT_INVALID_EVENT = "invalid_event"
+REJECT_INVALID_BINARY = "invalid_binary"
+REJECT_UNKNOWN_ENCODING = "unknown_encoding"
+# valid event Mongo can't store, e.g. an integer beyond 64 bits
+REJECT_UNENCODABLE = "unencodable"
+
+
+@dataclass
+class DecodedBatch:
+    # Each accepted event BSON-encoded for Mongo, _id included
+    documents: list[bytes] = field(default_factory=list)
+    columns: EventColumns = field(default_factory=EventColumns)
+    # (index into the raw values, reason) per dropped record
+    rejected: list[tuple[int, str]] = field(default_factory=list)
+    partials: PartialAggregates | None = None
+
+
+def parse_message(raw: bytes | None) -> tuple[dict | None, str | None]:
+    """Decode one value; returns (event, None) or (None, reject reason)."""
+    if not raw:
+        return None, REJECT_EMPTY
+
+    try:
+        obj = json.loads(raw)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None, REJECT_INVALID_JSON
+
+    if not isinstance(obj, dict):
+        return None, REJECT_NOT_OBJECT
+    return obj, None
+
+
+def parse_binary(raw: bytes) -> tuple[dict, datetime] | None:
+    """Decode one binary-v1 value; None if it is malformed."""
+    try:
+        version, micros = BINARY_HEADER.unpack_from(raw)
+        if version != BINARY_V1:
+            return None
+
+        pos = BINARY_HEADER.size
+        strings = []
+        for _ in range(3):
+            (size,) = BINARY_LENGTH.unpack_from(raw, pos)
+            pos += BINARY_LENGTH.size
+            if pos + size > len(raw):
+                return None
+            strings.append(raw[pos : pos + size].decode())
+            pos += size
+
+        payload = json.loads(raw[pos:]) if pos < len(raw) else {}
+        ts = EPOCH + timedelta(microseconds=micros)
+    except (struct.error, ValueError, OverflowError):
+        # ValueError covers bad UTF-8 and bad payload JSON
+        return None
+
+    if not isinstance(payload, dict):
+        return None
+
+    event_id, user_id, event_type = strings
+    event = {
+        "event_id": event_id,
+        "user_id": user_id,
+        "event_type": event_type,
+        # Mongo keeps the ISO string, as for JSON records
+        "timestamp": ts.isoformat(),
+        "payload": payload,
+    }
+    return event, ts
+
+
+def encode_document(event: dict) -> bytes | None:
+    """BSON for one event with a fresh _id; None if Mongo can't store it.
+
+    The _id is fixed here so a retried insert_many hits duplicate keys.
+    """
+    try:
+        return bson.encode({"_id": bson.ObjectId(), **event})
+    except (BSONError, OverflowError):
+        return None
+
+
+def decode_values(
+    values: list[bytes | None],
+    encodings: list[bytes | None] | None = None,
+    rules: list[AggregationRule] | None = None,
+) -> DecodedBatch:
+    """Decode one batch; with ``rules`` also pre-aggregate it (streaming mode).
+
+    ``encodings`` holds each value's ``event-encoding`` header, None for JSON.
+    Events are BSON-encoded here rather than by the Mongo driver, so a record
+    Mongo can't store is rejected on its own instead of failing the batch,
+    and flat bytes are cheap to send back from a worker process.
+    """
+    decoded = DecodedBatch()
+    columns = decoded.columns
+    for i, raw in enumerate(values):
+        encoding = encodings[i] if encodings else None
+
+        if encoding is None:
+            event, reason = parse_message(raw)
+            if event is None:
+                decoded.rejected.append((i, reason))
+                continue
+            document = encode_document(event)
+            if document is None:
+                decoded.rejected.append((i, REJECT_UNENCODABLE))
+                continue
+            if not columns.append_event(event):
+                decoded.rejected.append((i, REJECT_INVALID_EVENT))
+                continue
+
+        elif encoding == ENCODING_BINARY_V1:
+            if not raw:
+                decoded.rejected.append((i, REJECT_EMPTY))
+                continue
+            parsed = parse_binary(raw)
+            if parsed is None:
+                decoded.rejected.append((i, REJECT_INVALID_BINARY))
+                continue
+            event, ts = parsed
+            document = encode_document(event)
+            if document is None:
+                decoded.rejected.append((i, REJECT_UNENCODABLE))
+                continue
+            columns.append_row(
+                event["event_id"], event["user_id"], event["event_type"], ts
+            )
+
+        else:
+            decoded.rejected.append((i, REJECT_UNKNOWN_ENCODING))
+            continue
+
+        decoded.documents.append(document)
+
+    if rules is not None:
+        decoded.partials = aggregate(columns, rules)
+    return decoded
+
+
+def decode_chunks(
+    values: list[bytes | None],
+    encodings: list[bytes | None],
+    bounds: list[int],
+    rules: list[AggregationRule] | None = None,
+) -> list[DecodedBatch]:
+    """``decode_values`` per slice of ``values`` ending at each of ``bounds``.
+
+    Rejected indices stay relative to the whole of ``values``.
+    """
+    parts = []
+    start = 0
+    for end in bounds:
+        part = decode_values(values[start:end], encodings[start:end], rules)
+        part.rejected = [(start + i, reason) for i, reason in part.rejected]
+        parts.append(part)
+        start = end
+    return parts
@@ -0,0 +1,138 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from aiokafka import AIOKafkaProducer
+from app.core.settings import settings
+from app.decode import ENCODING_HEADER
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class DeadLetter:
+    topic: str
+    partition: int
+    offset: int
+    reason: str
+    value: bytes | None
+    # original event-encoding header, None for JSON
+    encoding: bytes | None = None
+
+
+class ErrorCounter:
+    """Counts rejected records by reason and logs a summary at most every ``interval``."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.totals: dict[str, int] = {}
+        self._window: dict[str, int] = {}
+        self._logged_at = time.monotonic()
+
+    def add(self, reason: str, count: int = 1):
+        self.totals[reason] = self.totals.get(reason, 0) + count
+        self._window[reason] = self._window.get(reason, 0) + count
+
+    def maybe_log(self):
+        now = time.monotonic()
+        if not self._window or now - self._logged_at < self.interval:
+            return
+
+        logger.warning(
+            "⚠️ Rejected Kafka records in the last %.0fs: %s (total: %s)",
+            now - self._logged_at,
+            self._window,
+            self.totals,
+        )
+        self._window = {}
+        self._logged_at = now
+
+
+class KafkaDeadLetterSink:
+    """Re-publishes the original value to DLQ_TOPIC with its origin as headers."""
+
+    def __init__(self, topic: str):
+        self.topic = topic
+        self._producer: AIOKafkaProducer | None = None
+
+    async def start(self):
+        self._producer = AIOKafkaProducer(
+            bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS,
+            acks="all",
+            enable_idempotence=True,
+            linger_ms=50,
+            compression_type="lz4",
+        )
+        await self._producer.start()
+
+    async def stop(self):
+        if self._producer:
+            await self._producer.stop()
+
+    async def send(self, letters: list[DeadLetter]):
+        futures = []
+        for letter in letters:
+            headers = [
+                ("dlq.topic", letter.topic.encode()),
+                ("dlq.partition", str(letter.partition).encode()),
+                ("dlq.offset", str(letter.offset).encode()),
+                ("dlq.reason", letter.reason.encode()),
+            ]
+            if letter.encoding is not None:
+                headers.append((ENCODING_HEADER, letter.encoding))
+            futures.append(
+                await self._producer.send(
+                    self.topic, value=letter.value, headers=headers
+                )
+            )
+        # One wait for the whole batch
+        await asyncio.gather(*futures)
+
+
+class FileDeadLetterSink:
+    """Appends one JSON line per record to a local file, fsynced per batch."""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    async def start(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    async def stop(self):
+        pass
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        with open(path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def send(self, letters: list[DeadLetter]):
+        data = b"".join(
+            json.dumps(
+                {
+                    "topic": letter.topic,
+                    "partition": letter.partition,
+                    "offset": letter.offset,
+                    "reason": letter.reason,
+                    "encoding": letter.encoding.decode() if letter.encoding else None,
+                    "value": base64.b64encode(letter.value or b"").decode(),
+                }
+            ).encode()
+            + b"\n"
+            for letter in letters
+        )
+        await asyncio.to_thread(self._write, self.path, data)
+
+
+def make_dead_letter_sink() -> KafkaDeadLetterSink | FileDeadLetterSink | None:
+    if settings.DLQ_MODE == "kafka":
+        return KafkaDeadLetterSink(settings.DLQ_TOPIC)
+    if settings.DLQ_MODE == "file":
+        return FileDeadLetterSink(settings.DLQ_FILE)
+    return None
@@ -0,0 +1,46 @@
+"""Offset ranges inserted into ClickHouse but maybe not yet committed.
+
+Each partition's rows go to ClickHouse in chunks whose deduplication token
+is derived from the chunk's first and end offset. The start of a replay is
+always the committed offset, but where the lost run cut its chunks depends
+on fetch timing. So before a batch is inserted, the chunk ends it covers
+are written here, one document per partition, and a replay starting at the
+same offset cuts its chunks at the same ends.
+"""
+from aiokafka import TopicPartition
+from pymongo import UpdateOne
+from app.mongo import mongo_client
+
+
+class InsertLedger:
+    def __init__(self, collection):
+        self.collection = collection
+
+    @staticmethod
+    def _key(tp: TopicPartition) -> str:
+        return f"{tp.topic}:{tp.partition}"
+
+    async def pending(self, tp: TopicPartition) -> tuple[int, list[int]] | None:
+        """(first offset, chunk ends) last recorded for a partition."""
+        doc = await self.collection.find_one({"_id": self._key(tp)})
+        if doc is None:
+            return None
+        return doc["start"], doc["ends"]
+
+    async def record(self, chunks: dict[TopicPartition, tuple[int, list[int]]]):
+        if not chunks:
+            return
+        await self.collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": self._key(tp)},
+                    {"$set": {"start": start, "ends": ends}},
+                    upsert=True,
+                )
+                for tp, (start, ends) in chunks.items()
+            ],
+            ordered=False,
+        )
+
+
+insert_ledger = InsertLedger(mongo_client.db.clickhouse_inserts)
@@ -1,6 +1,7 @@
 import asyncio
 from app.consumer import event_consumer
 from app.core.logging import setup_logging
+from app.aggregation.registry import rule_registry
 from app.aggregation.scheduler import AggregationScheduler
 from app.clickhouse import clickhouse_client
 import logging
@@ -15,6 +16,12 @@ async def main():
 
     logger.info("🚀 Services starting...")
 
+    # Consumer and scheduler both read rules, neither owns the registry
+    registry_task = asyncio.create_task(
+        rule_registry.run(),
+        name="rule-registry",
+    )
+
     # 1️⃣ Kafka consumer start
     await event_consumer.start()
 
@@ -34,7 +41,7 @@ async def main():
     try:
         # 3️⃣ IKKALASINI KUZATAMIZ
         done, pending = await asyncio.wait(
-            [consumer_task, scheduler_task],
+            [consumer_task, scheduler_task, registry_task],
             return_when=asyncio.FIRST_EXCEPTION,
         )
 
@@ -54,10 +61,12 @@ async def main():
         # TASKLARNI TO‘XTATAMIZ
         consumer_task.cancel()
         scheduler_task.cancel()
+        registry_task.cancel()
 
         await asyncio.gather(
             consumer_task,
             scheduler_task,
+            registry_task,
             return_exceptions=True,
         )
 
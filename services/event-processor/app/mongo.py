@@ -1,4 +1,6 @@
+from bson.raw_bson import RawBSONDocument
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
 from app.core.settings import settings
 
 class MongoClient:
@@ -7,9 +9,18 @@ class MongoClient:
         self.db = self.client[settings.MONGO_DB]
         self.collection = self.db.events_raw
 
-    async def insert_many(self, events: list[dict]):
-        if events:
-            await self.collection.insert_many(events)
+    async def insert_many(self, events: list[RawBSONDocument]):
+        if not events:
+            return
+
+        # Each document got its _id when it was decoded, so a retry of the
+        # same batch only hits duplicate keys for documents that made it in.
+        try:
+            await self.collection.insert_many(events, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
 
 
 mongo_client = MongoClient()
@@ -0,0 +1,97 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+
+pytest.importorskip("aiokafka")
+pytest.importorskip("motor")
+
+from aiokafka import TopicPartition
+from app import consumer as consumer_module
+from app.consumer import ConsumedBatch, EventConsumer
+from app.core.settings import settings
+
+TP = TopicPartition("events_raw", 3)
+OTHER = TopicPartition("events_raw", 7)
+
+
+def _messages(first: int, last: int) -> list:
+    return [
+        SimpleNamespace(offset=offset, value=b"{}", headers=())
+        for offset in range(first, last + 1)
+    ]
+
+
+def _chunks(batch: ConsumedBatch) -> list[tuple]:
+    return [(c.tp, c.start, c.end, c.first, c.last) for c in batch.chunks]
+
+
+def test_replay_reproduces_the_recorded_chunks():
+    # The lost run got 10..14 before its linger expired
+    lost = ConsumedBatch()
+    lost.add(TP, _messages(10, 14))
+    lost.add(OTHER, _messages(0, 1))
+    lost.seal({})
+    assert lost.ledger() == {TP: (10, [15]), OTHER: (0, [2])}
+
+    # The replay gets more at once: it must not stop inside 10..14, and
+    # must cut there to resend the same token
+    cuts = {TP: [15]}
+    replay = ConsumedBatch()
+    replay.add(TP, _messages(10, 12))
+    assert replay.inside(cuts)
+
+    replay.add(TP, _messages(13, 19))
+    assert not replay.inside(cuts)
+    replay.seal(cuts)
+
+    assert _chunks(replay) == [(TP, 10, 15, 0, 5), (TP, 15, 20, 5, 10)]
+    assert replay.chunks[0].dedup_token == lost.chunks[0].dedup_token
+    assert replay.offsets == {TP: 20}
+
+
+def test_reset_partition_is_dropped_from_the_batch():
+    batch = ConsumedBatch()
+    batch.add(TP, _messages(10, 14))
+    batch.add(OTHER, _messages(0, 1))
+    batch.drop(TP)
+
+    assert batch.size == 2
+    assert batch.offsets == {OTHER: 2}
+
+
+class _FakeKafka:
+    def __init__(self, **kwargs):
+        self.listener = None
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    def subscribe(self, topics, listener=None):
+        self.listener = listener
+
+
+def test_pipeline_failing_before_consume_stops_the_consumer(monkeypatch):
+    monkeypatch.setattr(consumer_module, "AIOKafkaConsumer", _FakeKafka)
+    monkeypatch.setattr(settings, "CONSUMER_MODE", "partition")
+    monkeypatch.setattr(settings, "DLQ_MODE", "off")
+
+    async def failing_pipeline(partitions, stop=None):
+        raise RuntimeError("sink down")
+
+    async def run():
+        consumer = EventConsumer()
+        monkeypatch.setattr(consumer, "_run_pipeline", failing_pipeline)
+        await consumer.start()
+
+        # Assigned, and failed, while consume() was not yet awaited
+        await consumer.consumer.listener.on_partitions_assigned([TP])
+        await asyncio.sleep(0)
+
+        with pytest.raises(RuntimeError, match="sink down"):
+            await asyncio.wait_for(consumer.consume(), timeout=5)
+        await consumer.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+import json
+import pytest
+
+pytest.importorskip("bson")
+
+from bson.raw_bson import RawBSONDocument
+from app.decode import REJECT_UNENCODABLE, decode_values
+
+
+def _event(event_id: str, **payload) -> bytes:
+    return json.dumps(
+        {
+            "event_id": event_id,
+            "user_id": "user-1",
+            "event_type": "click",
+            "timestamp": "2026-01-13T10:00:00Z",
+            "payload": payload,
+        }
+    ).encode()
+
+
+def test_record_mongo_cannot_store_is_rejected_alone():
+    # Valid JSON, but beyond BSON's 64-bit integers
+    decoded = decode_values([_event("a", n=2**64 - 1), _event("b", n=1)])
+
+    assert decoded.rejected == [(0, REJECT_UNENCODABLE)]
+    assert decoded.columns.event_id == ["b"]
+    [document] = [RawBSONDocument(d) for d in decoded.documents]
+    assert document["event_id"] == "b"
+    assert "_id" in document
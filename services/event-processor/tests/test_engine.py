@@ -0,0 +1,200 @@
+"""Integration test against the ClickHouse from docker-compose.
+
+Needs infra/clickhouse/init applied; skipped when ClickHouse is unreachable.
+
+    cd services/event-processor
+    CLICKHOUSE_HOST=localhost python -m pytest tests
+"""
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+import pytest
+
+pytest.importorskip("clickhouse_connect")
+
+from app.aggregation.engine import AggregationEngine
+from app.aggregation.planner import window_floor
+from app.aggregation.rules import ALL_MARKER, AggregationRule
+from app.clickhouse import clickhouse_client
+from app.columns import COLUMN_NAMES
+from app.core.settings import settings
+
+
+async def _insert(event_type: str, user_id: str, ts: datetime):
+    client = await clickhouse_client.get_client()
+    await client.insert(
+        "events_fact",
+        [[str(uuid.uuid4()), user_id, event_type, ts]],
+        column_names=COLUMN_NAMES,
+    )
+
+
+async def _values(rule: AggregationRule, event_type: str) -> dict[tuple, int]:
+    client = await clickhouse_client.get_client()
+    result = await client.query(
+        """
+        SELECT group_values, value
+        FROM analytics.events_agg FINAL
+        WHERE rule_id = %(rule_id)s
+          AND group_values[1] = %(event_type)s
+        """,
+        parameters={"rule_id": rule.rule_id, "event_type": event_type},
+    )
+    return {tuple(values): value for values, value in result.result_rows}
+
+
+async def _shared_scan_with_rollup():
+    try:
+        client = await clickhouse_client.get_client()
+        await client.query("SELECT 1")
+    except Exception as e:
+        pytest.skip(f"ClickHouse unavailable: {e!r}")
+
+    suffix = uuid.uuid4().hex[:12]
+    event_type = f"test_{suffix}"
+    rules = [
+        AggregationRule(
+            rule_id=f"test_scan_rollup_{suffix}",
+            window_size="1h",
+            metric="event_count",
+            group_by=["event_type", "user_id"],
+            group_mode="rollup",
+        ),
+        AggregationRule(
+            rule_id=f"test_scan_users_{suffix}",
+            window_size="1h",
+            metric="active_users",
+            group_by=["event_type"],
+        ),
+    ]
+    ts = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    ts -= timedelta(hours=1)
+
+    try:
+        await _insert(event_type, "user-1", ts)
+        await _insert(event_type, "user-1", ts + timedelta(minutes=1))
+        await _insert(event_type, "user-2", ts + timedelta(minutes=2))
+
+        # Both rules are fresh, so they share one scan through run_group
+        assert await AggregationEngine().run_rules(rules) == set()
+
+        assert await _values(rules[0], event_type) == {
+            (event_type, "user-1"): 2,
+            (event_type, "user-2"): 1,
+            (event_type, ALL_MARKER): 3,
+        }
+        assert await _values(rules[1], event_type) == {(event_type,): 2}
+    finally:
+        rule_ids = [r.rule_id for r in rules]
+        for table in ("events_agg", "aggregation_state"):
+            await client.command(
+                f"ALTER TABLE analytics.{table} "
+                "DELETE WHERE rule_id IN %(rule_ids)s",
+                parameters={"rule_ids": rule_ids},
+            )
+        await client.command(
+            "ALTER TABLE analytics.events_fact "
+            "DELETE WHERE event_type = %(event_type)s",
+            parameters={"event_type": event_type},
+        )
+
+
+def test_shared_scan_fans_out_grouping_sets():
+    asyncio.run(_shared_scan_with_rollup())
+
+
+async def _future_event_does_not_stall():
+    try:
+        client = await clickhouse_client.get_client()
+        await client.query("SELECT 1")
+    except Exception as e:
+        pytest.skip(f"ClickHouse unavailable: {e!r}")
+
+    suffix = uuid.uuid4().hex[:12]
+    event_type = f"test_{suffix}"
+    rule = AggregationRule(
+        rule_id=f"test_future_{suffix}",
+        window_size="1h",
+        metric="event_count",
+        group_by=["event_type"],
+    )
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    engine = AggregationEngine()
+
+    try:
+        await _insert(event_type, "user-1", datetime(2099, 1, 1, tzinfo=timezone.utc))
+        await engine.run_rules([rule])
+        await _insert(event_type, "user-1", now - timedelta(seconds=1))
+        await engine.run_rules([rule])
+
+        watermark = (await engine.get_watermarks(client, [rule.rule_id]))[
+            rule.rule_id
+        ]
+        assert watermark.replace(tzinfo=timezone.utc) <= now
+        assert await _values(rule, event_type) == {(event_type,): 1}
+    finally:
+        for table in ("events_agg", "aggregation_state"):
+            await client.command(
+                f"ALTER TABLE analytics.{table} DELETE WHERE rule_id = %(rule_id)s",
+                parameters={"rule_id": rule.rule_id},
+            )
+        await client.command(
+            "ALTER TABLE analytics.events_fact "
+            "DELETE WHERE event_type = %(event_type)s",
+            parameters={"event_type": event_type},
+        )
+
+
+def test_future_event_does_not_move_the_watermark():
+    asyncio.run(_future_event_does_not_stall())
+
+
+async def _floors_follow_the_newest_event():
+    try:
+        client = await clickhouse_client.get_client()
+        await client.query("SELECT 1")
+    except Exception as e:
+        pytest.skip(f"ClickHouse unavailable: {e!r}")
+
+    suffix = uuid.uuid4().hex[:12]
+    event_type = f"test_{suffix}"
+    ran, fresh = [
+        AggregationRule(
+            rule_id=f"test_floor_{name}_{suffix}",
+            window_size="1m",
+            metric="event_count",
+            group_by=["event_type"],
+        )
+        for name in ("ran", "fresh")
+    ]
+    engine = AggregationEngine()
+
+    try:
+        await _insert(event_type, "user-1", datetime(2099, 1, 1, tzinfo=timezone.utc))
+        await _insert(event_type, "user-1", datetime.now(timezone.utc))
+        await engine.run_rules([ran])
+        newest = datetime.now(timezone.utc)
+
+        floors = await engine.scan_floors([ran, fresh])
+
+        # Future-dated events don't count, and a rule that never ran
+        # rescans everything anyway
+        assert list(floors) == [ran.rule_id]
+        floor = floors[ran.rule_id].replace(tzinfo=timezone.utc)
+        lateness = timedelta(seconds=settings.AGGREGATION_LATENESS_SECONDS)
+        assert floor <= window_floor(newest - lateness, ran.window_seconds)
+    finally:
+        for table in ("events_agg", "aggregation_state"):
+            await client.command(
+                f"ALTER TABLE analytics.{table} DELETE WHERE rule_id = %(rule_id)s",
+                parameters={"rule_id": ran.rule_id},
+            )
+        await client.command(
+            "ALTER TABLE analytics.events_fact "
+            "DELETE WHERE event_type = %(event_type)s",
+            parameters={"event_type": event_type},
+        )
+
+
+def test_scan_floors_follow_the_newest_event():
+    asyncio.run(_floors_follow_the_newest_event())
@@ -0,0 +1,92 @@
+"""Integration test against the ClickHouse from docker-compose.
+
+Needs infra/clickhouse/init applied; skipped when ClickHouse is unreachable.
+
+    cd services/event-processor
+    CLICKHOUSE_HOST=localhost python -m pytest tests
+"""
+import asyncio
+import uuid
+from datetime import datetime, timedelta, timezone
+import pytest
+
+pytest.importorskip("clickhouse_connect")
+
+from app.aggregation.materialized import MaterializedViewManager, view_name
+from app.aggregation.rules import AggregationRule
+from app.clickhouse import clickhouse_client
+from app.columns import COLUMN_NAMES
+from app.core.settings import settings
+
+
+async def _insert(event_type: str, ts: datetime):
+    client = await clickhouse_client.get_client()
+    await client.insert(
+        "events_fact",
+        [[str(uuid.uuid4()), "user-1", event_type, ts]],
+        column_names=COLUMN_NAMES,
+    )
+
+
+async def _counts(rule: AggregationRule, event_type: str) -> dict[datetime, int]:
+    client = await clickhouse_client.get_client()
+    result = await client.query(
+        """
+        SELECT window_start, sum(value)
+        FROM analytics.events_agg_state
+        WHERE rule_id = %(rule_id)s
+          AND group_key = %(event_type)s
+        GROUP BY window_start
+        """,
+        parameters={"rule_id": rule.rule_id, "event_type": event_type},
+    )
+    return {
+        window.replace(tzinfo=timezone.utc): count
+        for window, count in result.result_rows
+    }
+
+
+async def _late_event_after_create():
+    try:
+        client = await clickhouse_client.get_client()
+        await client.query("SELECT 1")
+    except Exception as e:
+        pytest.skip(f"ClickHouse unavailable: {e!r}")
+
+    suffix = uuid.uuid4().hex[:12]
+    event_type = f"test_{suffix}"
+    rule = AggregationRule(
+        rule_id=f"test_late_{suffix}",
+        window_size="1h",
+        metric="event_count",
+        group_by=["event_type"],
+    )
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    current = now.replace(minute=0, second=0)
+    late = current - timedelta(hours=2)
+
+    manager = MaterializedViewManager()
+    try:
+        await _insert(event_type, now)
+        await manager.create(rule)
+        # Older than any window the view was created in
+        await _insert(event_type, late + timedelta(minutes=5))
+
+        assert await _counts(rule, event_type) == {current: 1, late: 1}
+    finally:
+        await manager.drop(view_name(rule))
+        await client.command(
+            "ALTER TABLE analytics.events_agg_state "
+            "DELETE WHERE rule_id = %(rule_id)s",
+            parameters={"rule_id": rule.rule_id},
+        )
+        await client.command(
+            "ALTER TABLE analytics.events_fact "
+            "DELETE WHERE event_type = %(event_type)s",
+            parameters={"event_type": event_type},
+        )
+
+
+def test_late_event_after_view_creation_is_counted(monkeypatch):
+    monkeypatch.setattr(settings, "AGGREGATION_VIEW_CUTOFF_SECONDS", 1.0)
+    asyncio.run(_late_event_after_create())
@@ -1,29 +1,181 @@
-from fastapi import APIRouter, HTTPException
+import orjson
+from fastapi import APIRouter, HTTPException, Request
 from typing import List
 from app.schemas.event import EventSchema
-from app.core.kafka import kafka_producer
+from app.core.config import settings
+from app.core.kafka import encode_event
+from app.services.events import (
+    EventValidationError,
+    TooManyEventsError,
+    validate_event,
+    validate_raw_events,
+)
+from app.services.ndjson import (
+    CorruptStreamError,
+    LineTooLongError,
+    NDJSONDecoder,
+    UnsupportedEncodingError,
+)
 from app.services.queue import event_queue
+from app.services.spill import SpillFullError, spill_log
 
 router = APIRouter()
 
+MAX_EVENTS_PER_REQUEST = 10_000
+
+
+def _overloaded() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="Ingest overloaded, try again later",
+        headers={"Retry-After": str(event_queue.retry_after())},
+    )
+
+
+def _ensure_capacity():
+    if event_queue.overloaded and spill_log is None:
+        raise _overloaded()
+
+
+async def _admit(records: list):
+    if event_queue.try_put(records):
+        return
+
+    if spill_log is None:
+        raise _overloaded()
+
+    # Queue is saturated: park the batch on disk instead of rejecting it
+    try:
+        await spill_log.append(records)
+    except SpillFullError:
+        raise _overloaded()
+
 
 @router.post("/ingest")
 async def ingest_events(events: List[EventSchema]):
-    if len(events) > 10_000:
+    if len(events) > MAX_EVENTS_PER_REQUEST:
         raise HTTPException(
             status_code=400,
             detail="Maximum 10,000 events per request",
         )
 
-    if event_queue.full():
+    _ensure_capacity()
+
+    await _admit([encode_event(e.model_dump(mode="json")) for e in events])
+
+    return {
+        "status": "accepted",
+        "count": len(events),
+    }
+
+
+@router.post(
+    "/ingest/raw",
+    summary="Ingest a JSON array of events without per-event models",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "type": "array",
+                        "items": EventSchema.model_json_schema(),
+                    }
+                }
+            },
+        }
+    },
+)
+async def ingest_events_raw(request: Request):
+    _ensure_capacity()
+
+    body = await request.body()
+    try:
+        records = validate_raw_events(body, MAX_EVENTS_PER_REQUEST)
+    except TooManyEventsError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except EventValidationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    await _admit(records)
+
+    return {
+        "status": "accepted",
+        "count": len(records),
+    }
+
+
+@router.post(
+    "/ingest/stream",
+    summary="Stream newline-delimited JSON events (gzip/zstd optional)",
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/x-ndjson": {
+                    "schema": {"type": "string", "format": "binary"}
+                }
+            },
+        }
+    },
+)
+async def ingest_events_stream(request: Request):
+    _ensure_capacity()
+
+    try:
+        decoder = NDJSONDecoder(
+            request.headers.get("content-encoding"),
+            max_line_bytes=settings.INGEST_STREAM_MAX_LINE_BYTES,
+        )
+    except UnsupportedEncodingError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+
+    batch_size = settings.INGEST_STREAM_BATCH_SIZE
+    batch = []
+    accepted = 0
+    rejected = 0
+
+    async def consume(lines):
+        nonlocal batch, accepted, rejected
+
+        for line in lines:
+            try:
+                batch.append(validate_event(orjson.loads(line), accepted + rejected))
+            except (orjson.JSONDecodeError, EventValidationError):
+                rejected += 1
+                continue
+
+            accepted += 1
+            if len(batch) >= batch_size:
+                # Blocks while the queue is full, which pauses the upload
+                await event_queue.put(batch)
+                batch = []
+
+    # Sub-batches already queued cannot be recalled, so errors report how
+    # many events made it in before the stream was aborted.
+    try:
+        async for chunk in request.stream():
+            await consume(decoder.feed(chunk))
+        await consume(decoder.close())
+    except LineTooLongError as e:
         raise HTTPException(
-            status_code=503,
-            detail="Ingest overloaded, try again later",
+            status_code=413,
+            detail={"error": str(e), "accepted": accepted - len(batch)},
+        )
+    except CorruptStreamError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": f"Corrupt request body: {e}",
+                "accepted": accepted - len(batch),
+            },
         )
 
-    await event_queue.put(events)
+    if batch:
+        await event_queue.put(batch)
 
     return {
         "status": "accepted",
-        "count": len(events),
+        "count": accepted,
+        "rejected": rejected,
     }
@@ -0,0 +1,78 @@
+"""Value encodings for events_raw.
+
+JSON is the default and the fallback. With KAFKA_EVENT_ENCODING=binary,
+events are written in a fixed-schema layout and tagged with the
+``event-encoding`` header; records without the header are JSON.
+
+binary-v1, little-endian:
+
+    u8 version (0x01) | i64 epoch microseconds (UTC)
+    | u16 length + UTF-8 event_id | same for user_id | same for event_type
+    | payload as JSON, to the end of the value (empty when there is none)
+"""
+import struct
+from datetime import datetime, timedelta, timezone
+import orjson
+from app.core.config import settings
+
+ENCODING_HEADER = "event-encoding"
+ENCODING_BINARY_V1 = b"binary-v1"
+
+BINARY_V1 = 0x01
+BINARY_HEADER = struct.Struct("<Bq")
+BINARY_LENGTH = struct.Struct("<H")
+MAX_STRING_BYTES = 0xFFFF
+
+# Anything else on an event only survives the JSON encoding
+BINARY_FIELDS = frozenset(("event_id", "user_id", "event_type", "timestamp", "payload"))
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
+
+# Headers per encoding; JSON records carry none, as before
+_BINARY_HEADERS = [(ENCODING_HEADER, ENCODING_BINARY_V1)]
+
+
+def encode_binary(event: dict, ts: datetime) -> bytes | None:
+    """binary-v1 value, or None if the event does not fit the schema."""
+    if not BINARY_FIELDS.issuperset(event):
+        return None
+
+    if ts.tzinfo is None:
+        # Same convention as the processor: naive timestamps are UTC
+        ts = ts.replace(tzinfo=timezone.utc)
+
+    parts = [BINARY_HEADER.pack(BINARY_V1, (ts - EPOCH) // MICROSECOND)]
+    for name in ("event_id", "user_id", "event_type"):
+        data = event[name].encode()
+        if len(data) > MAX_STRING_BYTES:
+            return None
+        parts.append(BINARY_LENGTH.pack(len(data)))
+        parts.append(data)
+
+    payload = event.get("payload")
+    if payload:
+        parts.append(orjson.dumps(payload))
+    return b"".join(parts)
+
+
+def encode_value(event: dict, ts: datetime | None = None) -> bytes:
+    """Serialize a validated event in the configured encoding.
+
+    ``ts`` is the already parsed timestamp, if the caller has it.
+    """
+    if settings.KAFKA_EVENT_ENCODING == "binary":
+        if ts is None:
+            ts = datetime.fromisoformat(event["timestamp"])
+        value = encode_binary(event, ts)
+        if value is not None:
+            return value
+    return orjson.dumps(event)
+
+
+def record_headers(value: bytes) -> list[tuple[str, bytes]]:
+    # A JSON object never starts with the version byte, so records keep
+    # their plain (key, value) form through the queue and the spill log
+    if value and value[0] == BINARY_V1:
+        return _BINARY_HEADERS
+    return []
@@ -6,6 +6,36 @@ class Settings(BaseSettings):
 
     KAFKA_BOOTSTRAP_SERVERS: str = "kafka-1:9092,kafka-2:9092,kafka-3:9092"
     KAFKA_TOPIC: str = "events_raw"
+    # "json" or "binary" (see app.core.codec); upgrade the event-processor
+    # before switching, older consumers only read JSON
+    KAFKA_EVENT_ENCODING: str = "json"
+
+    # Events dated further ahead than this are rejected: the aggregation
+    # watermark follows event time, so a far-future event would stall it
+    INGEST_MAX_FUTURE_SECONDS: int = 3600
+
+    # Admission control for the in-memory event queue
+    INGEST_QUEUE_MAX_EVENTS: int = 200_000
+    INGEST_QUEUE_MAX_BYTES: int = 256 * 1024 * 1024
+    INGEST_QUEUE_HIGH_WATERMARK: float = 0.9
+    INGEST_QUEUE_LOW_WATERMARK: float = 0.6
+    INGEST_WORKERS: int = 4
+
+    # Local disk spill log for batches Kafka could not take in time
+    SPILL_ENABLED: bool = False
+    SPILL_DIR: str = "/var/lib/ingestion/spill"
+    SPILL_SEGMENT_BYTES: int = 64 * 1024 * 1024
+    SPILL_MAX_BYTES: int = 10 * 1024 * 1024 * 1024
+    # The active segment drains once no batch spilled for SPILL_SEAL_IDLE_SECONDS,
+    # or at the latest once it is SPILL_SEAL_MAX_AGE_SECONDS old
+    SPILL_SEAL_IDLE_SECONDS: float = 5.0
+    SPILL_SEAL_MAX_AGE_SECONDS: float = 60.0
+    SPILL_DRAIN_BATCH_SIZE: int = 5000
+    SPILL_DRAIN_RATE: int = 20_000
+
+    # Streaming NDJSON ingest
+    INGEST_STREAM_BATCH_SIZE: int = 1000
+    INGEST_STREAM_MAX_LINE_BYTES: int = 1024 * 1024
 
     model_config = SettingsConfigDict(
         env_file=".env",
@@ -1,34 +1,43 @@
 import asyncio
 import logging
-import orjson
+import time
 from aiokafka import AIOKafkaProducer
-from aiokafka.errors import KafkaTimeoutError, KafkaConnectionError
+from aiokafka.partitioner import DefaultPartitioner
+from app.core.codec import encode_value, record_headers
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+# (key, value) pair, both already serialized
+Record = tuple[bytes, bytes]
+
+
+def encode_event(event: dict) -> Record:
+    return str(event["user_id"]).encode(), encode_value(event)
+
 
 class KafkaProducer:
     def __init__(self):
         self._producer: AIOKafkaProducer | None = None
+        self._partitioner = DefaultPartitioner()
 
         self.max_retries = 3
         self.retry_backoff = 0.5
 
-        self.max_inflight = 1000
-        self._semaphore = asyncio.Semaphore(self.max_inflight)
+        self.max_batch_size = 512 * 1024
 
     async def start(self):
         self._producer = AIOKafkaProducer(
             bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS,
 
-            value_serializer=lambda v: orjson.dumps(v),
+            partitioner=self._partitioner,
 
             acks="all",
             enable_idempotence=True,
 
             linger_ms=50,
             compression_type="lz4",
+            max_batch_size=self.max_batch_size,
             max_request_size=5 * 1024 * 1024,
 
             retry_backoff_ms=500,
@@ -38,37 +47,118 @@ class KafkaProducer:
         await self._producer.start()
         logger.info("✅ Kafka producer started")
 
-    async def _send_one(self, event: dict):
+    async def _group_by_partition(
+        self, records: list[Record]
+    ) -> dict[int, list[Record]]:
+        partitions = sorted(await self._producer.partitions_for(settings.KAFKA_TOPIC))
+
+        grouped: dict[int, list[Record]] = {}
+        for record in records:
+            partition = self._partitioner(record[0], partitions, partitions)
+            grouped.setdefault(partition, []).append(record)
+        return grouped
+
+    async def _enqueue_partition(
+        self, partition: int, records: list[Record]
+    ) -> list[tuple[asyncio.Future, list[Record]]]:
+        """Pack a partition's records into as few batches as possible."""
+        pending = []
+        batch = self._producer.create_batch()
+        members: list[Record] = []
+
+        for record in records:
+            key, value = record
+            headers = record_headers(value)
+            if (
+                batch.append(key=key, value=value, timestamp=None, headers=headers)
+                is None
+            ):
+                fut = await self._producer.send_batch(
+                    batch, settings.KAFKA_TOPIC, partition=partition
+                )
+                pending.append((fut, members))
+
+                batch = self._producer.create_batch()
+                members = []
+                batch.append(key=key, value=value, timestamp=None, headers=headers)
+
+            members.append(record)
 
-        async with self._semaphore:
-            await self._producer.send_and_wait(
-                topic=settings.KAFKA_TOPIC,
-                key=str(event["user_id"]).encode(),
-                value=event,
+        if members:
+            fut = await self._producer.send_batch(
+                batch, settings.KAFKA_TOPIC, partition=partition
             )
+            pending.append((fut, members))
 
-    async def send_batch(self, events: list[dict]):
-        if not self._producer or not events:
-            return
+        return pending
 
-        attempt = 0
-        while attempt < self.max_retries:
-            try:
-                tasks = [self._send_one(e) for e in events]
-                await asyncio.gather(*tasks)
-                return  # ✅ success
+    async def _send_once(self, records: list[Record]) -> list[Record]:
+        """Enqueue every record, wait once, return the records that failed."""
+        pending = []
+        for partition, part_records in (
+            await self._group_by_partition(records)
+        ).items():
+            pending.extend(await self._enqueue_partition(partition, part_records))
 
-            except (KafkaTimeoutError, KafkaConnectionError) as e:
-                attempt += 1
+        results = await asyncio.gather(
+            *(fut for fut, _ in pending),
+            return_exceptions=True,
+        )
+
+        failed: list[Record] = []
+        for (_, members), result in zip(pending, results):
+            if isinstance(result, BaseException):
                 logger.warning(
-                    f"Kafka batch send failed "
-                    f"(attempt {attempt}/{self.max_retries}): {e}"
+                    "Kafka batch of %d records failed: %r", len(members), result
                 )
+                failed.extend(members)
+        return failed
+
+    async def send_records(self, records: list[Record]) -> list[Record]:
+        """Produce pre-serialized records; returns whatever could not be sent."""
+        if not self._producer or not records:
+            return records
+
+        started = time.perf_counter()
+        total = len(records)
+
+        attempt = 0
+        while records and attempt < self.max_retries:
+            if attempt:
                 await asyncio.sleep(self.retry_backoff * attempt)
+            attempt += 1
 
+            try:
+                records = await self._send_once(records)
             except Exception:
                 logger.exception("❌ Unexpected Kafka error")
-                return
+                break
+
+            if records:
+                logger.warning(
+                    "Kafka batch send incomplete, %d records left "
+                    "(attempt %d/%d)",
+                    len(records),
+                    attempt,
+                    self.max_retries,
+                )
+
+        elapsed = time.perf_counter() - started
+        sent = total - len(records)
+        logger.info(
+            "📤 Kafka batch: %d/%d records in %.1f ms (%d events/sec)",
+            sent,
+            total,
+            elapsed * 1000,
+            sent / elapsed if elapsed > 0 else 0,
+        )
+        if records:
+            logger.error("❌ Kafka batch gave up on %d records", len(records))
+
+        return records
+
+    async def send_batch(self, events: list[dict]) -> list[Record]:
+        return await self.send_records([encode_event(e) for e in events])
 
     async def stop(self):
         if self._producer:
@@ -4,12 +4,33 @@ from fastapi import FastAPI
 from app.services.worker import kafka_worker
 from app.core.kafka import kafka_producer
 from app.core.logging import setup_logging
+from app.core.config import settings
+from app.services.spill import spill_log
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     setup_logging()
     await kafka_producer.start()
-    asyncio.create_task(kafka_worker())
+    if spill_log is not None:
+        spill_log.open()
+
+    workers = [
+        asyncio.create_task(kafka_worker(), name=f"kafka-worker-{i}")
+        for i in range(settings.INGEST_WORKERS)
+    ]
+    if spill_log is not None:
+        workers.append(
+            asyncio.create_task(
+                spill_log.drain(
+                    batch_size=settings.SPILL_DRAIN_BATCH_SIZE,
+                    rate=settings.SPILL_DRAIN_RATE,
+                ),
+                name="spill-drainer",
+            )
+        )
     yield
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
     await kafka_producer.stop()
@@ -1,6 +1,17 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from typing import Any
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+from app.core.config import settings
+
+
+def too_far_ahead(ts: datetime) -> bool:
+    if ts.tzinfo is None:
+        # Same convention as the processor: naive timestamps are UTC
+        ts = ts.replace(tzinfo=timezone.utc)
+    horizon = datetime.now(timezone.utc) + timedelta(
+        seconds=settings.INGEST_MAX_FUTURE_SECONDS
+    )
+    return ts > horizon
 
 
 class EventSchema(BaseModel):
@@ -9,3 +20,10 @@ class EventSchema(BaseModel):
     event_type: str
     timestamp: datetime
     payload: dict[str, Any] = Field(default_factory=dict)
+
+    @field_validator("timestamp")
+    @classmethod
+    def not_too_far_ahead(cls, ts: datetime) -> datetime:
+        if too_far_ahead(ts):
+            raise ValueError("timestamp is too far in the future")
+        return ts
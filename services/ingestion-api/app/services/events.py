@@ -0,0 +1,60 @@
+from datetime import datetime
+import orjson
+from app.core.codec import encode_value
+from app.core.kafka import Record
+from app.schemas.event import too_far_ahead
+
+REQUIRED_FIELDS = ("event_id", "user_id", "event_type")
+
+
+class EventValidationError(ValueError):
+    pass
+
+
+class TooManyEventsError(EventValidationError):
+    pass
+
+
+def validate_event(event, index: int = 0) -> Record:
+    """Check one decoded event and turn it into a Kafka record."""
+    if not isinstance(event, dict):
+        raise EventValidationError(f"event {index}: expected an object")
+
+    for field in REQUIRED_FIELDS:
+        if not isinstance(event.get(field), str):
+            raise EventValidationError(f"event {index}: '{field}' must be a string")
+
+    ts = event.get("timestamp")
+    if not isinstance(ts, str):
+        raise EventValidationError(f"event {index}: 'timestamp' must be a string")
+    try:
+        parsed = datetime.fromisoformat(ts)
+    except ValueError:
+        raise EventValidationError(
+            f"event {index}: 'timestamp' is not ISO 8601"
+        ) from None
+    if too_far_ahead(parsed):
+        raise EventValidationError(
+            f"event {index}: 'timestamp' is too far in the future"
+        )
+
+    payload = event.get("payload")
+    if payload is not None and not isinstance(payload, dict):
+        raise EventValidationError(f"event {index}: 'payload' must be an object")
+
+    return event["user_id"].encode(), encode_value(event, parsed)
+
+
+def validate_raw_events(body: bytes, max_events: int) -> list[Record]:
+    """Validate a JSON array body in one pass without building models."""
+    try:
+        events = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        raise EventValidationError(f"invalid JSON: {e}") from None
+
+    if not isinstance(events, list):
+        raise EventValidationError("expected a JSON array of events")
+    if len(events) > max_events:
+        raise TooManyEventsError(f"Maximum {max_events:,} events per request")
+
+    return [validate_event(e, i) for i, e in enumerate(events)]
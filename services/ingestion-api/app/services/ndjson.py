@@ -0,0 +1,111 @@
+import zlib
+from typing import Iterator
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for Content-Encoding: zstd
+    zstandard = None
+
+SUPPORTED_ENCODINGS = ("identity", "gzip", "zstd")
+
+# zstd has no output limit per call, but a block expands to at most 128 KiB
+# from at least 4 input bytes: 64-byte steps yield at most 2 MiB each.
+ZSTD_INPUT_STEP = 64
+
+
+class UnsupportedEncodingError(ValueError):
+    pass
+
+
+class LineTooLongError(ValueError):
+    pass
+
+
+class CorruptStreamError(ValueError):
+    pass
+
+
+class NDJSONDecoder:
+    """Incrementally split a (possibly compressed) byte stream into lines."""
+
+    def __init__(
+        self,
+        content_encoding: str | None,
+        max_line_bytes: int,
+        read_size: int = 256 * 1024,
+    ):
+        encoding = (content_encoding or "identity").strip().lower()
+        self._max_line_bytes = max_line_bytes
+        self._read_size = read_size
+        self._tail = b""
+        self._zlib = None
+        self._zstd = None
+
+        if encoding == "gzip":
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "zstd":
+            if zstandard is None:
+                raise UnsupportedEncodingError("zstd support is not installed")
+            self._zstd = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding != "identity":
+            raise UnsupportedEncodingError(f"Unsupported Content-Encoding: {encoding}")
+
+    def _decompress(self, chunk: bytes) -> Iterator[bytes]:
+        try:
+            if self._zstd is not None:
+                for start in range(0, len(chunk), ZSTD_INPUT_STEP):
+                    data = self._zstd.decompress(
+                        chunk[start : start + ZSTD_INPUT_STEP]
+                    )
+                    if data:
+                        yield data
+            elif self._zlib is not None:
+                # Bounded output per step so a small compressed chunk cannot
+                # expand into one huge buffer.
+                data = chunk
+                while data:
+                    yield self._zlib.decompress(data, self._read_size)
+                    data = self._zlib.unconsumed_tail
+            else:
+                yield chunk
+        except zlib.error as e:
+            raise CorruptStreamError(str(e)) from None
+        except Exception as e:
+            if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                raise CorruptStreamError(str(e)) from None
+            raise
+
+    def _split(self, data: bytes) -> Iterator[bytes]:
+        data = self._tail + data
+        lines = data.split(b"\n")
+        self._tail = lines.pop()
+
+        if len(self._tail) > self._max_line_bytes:
+            raise LineTooLongError(
+                f"Line exceeds {self._max_line_bytes} bytes"
+            )
+
+        for line in lines:
+            if len(line) > self._max_line_bytes:
+                raise LineTooLongError(
+                    f"Line exceeds {self._max_line_bytes} bytes"
+                )
+            line = line.strip()
+            if line:
+                yield line
+
+    def feed(self, chunk: bytes) -> Iterator[bytes]:
+        for data in self._decompress(chunk):
+            yield from self._split(data)
+
+    def close(self) -> Iterator[bytes]:
+        if self._zlib is not None:
+            try:
+                data = self._zlib.flush()
+            except zlib.error as e:
+                raise CorruptStreamError(str(e)) from None
+            yield from self._split(data)
+
+        line, self._tail = self._tail.strip(), b""
+        if line:
+            yield line
@@ -1,3 +1,140 @@
 import asyncio
+import math
+import time
+from dataclasses import dataclass
+from app.core.config import settings
+from app.core.kafka import Record
 
-event_queue: asyncio.Queue[list] = asyncio.Queue(maxsize=100)
+
+@dataclass(slots=True)
+class QueuedBatch:
+    records: list[Record]
+    events: int
+    nbytes: int
+
+
+class AdmissionController:
+    """Event queue bounded by event count and payload bytes.
+
+    Usage counts both queued and in-flight batches and is only released by
+    ``task_done``. Once usage crosses the high watermark new work is refused
+    until workers drain it below the low watermark.
+    """
+
+    def __init__(
+        self,
+        max_events: int,
+        max_bytes: int,
+        high_watermark: float,
+        low_watermark: float,
+    ):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+
+        self.events = 0
+        self.nbytes = 0
+        self.overloaded = False
+
+        self._queue: asyncio.Queue[QueuedBatch] = asyncio.Queue()
+        self._released = asyncio.Condition()
+        self._waiting = 0
+
+        # Smoothed drain rate, events/sec
+        self.drain_rate = 0.0
+        self._last_release: float | None = None
+
+    def _usage(self, events: int = 0, nbytes: int = 0) -> float:
+        return max(
+            (self.events + events) / self.max_events,
+            (self.nbytes + nbytes) / self.max_bytes,
+        )
+
+    def _fits(self, batch: QueuedBatch) -> bool:
+        if self.events == 0:
+            # An oversized batch is still admitted into an empty queue
+            return True
+        return self._usage(batch.events, batch.nbytes) <= 1.0
+
+    def _admit(self, batch: QueuedBatch):
+        self.events += batch.events
+        self.nbytes += batch.nbytes
+        if self._usage() >= self.high_watermark:
+            self.overloaded = True
+        self._queue.put_nowait(batch)
+
+    @staticmethod
+    def _make_batch(records: list[Record]) -> QueuedBatch:
+        return QueuedBatch(
+            records=records,
+            events=len(records),
+            nbytes=sum(len(k) + len(v) for k, v in records),
+        )
+
+    def try_put(self, records: list[Record]) -> bool:
+        batch = self._make_batch(records)
+        if self.overloaded or not self._fits(batch):
+            return False
+
+        self._admit(batch)
+        return True
+
+    async def put(self, records: list[Record]):
+        """Admit a batch, waiting for workers to drain the queue if needed."""
+        batch = self._make_batch(records)
+        async with self._released:
+            self._waiting += 1
+            try:
+                await self._released.wait_for(
+                    lambda: not self.overloaded and self._fits(batch)
+                )
+            finally:
+                self._waiting -= 1
+            self._admit(batch)
+
+    async def get(self) -> QueuedBatch:
+        return await self._queue.get()
+
+    def task_done(self, batch: QueuedBatch):
+        self.events -= batch.events
+        self.nbytes -= batch.nbytes
+        self._queue.task_done()
+
+        now = time.monotonic()
+        if self._last_release is not None:
+            elapsed = max(now - self._last_release, 1e-3)
+            rate = batch.events / elapsed
+            self.drain_rate = (
+                rate if not self.drain_rate else 0.8 * self.drain_rate + 0.2 * rate
+            )
+        self._last_release = now
+
+        if self.overloaded and self._usage() <= self.low_watermark:
+            self.overloaded = False
+
+        if self._waiting:
+            asyncio.get_running_loop().create_task(self._notify())
+
+    async def _notify(self):
+        async with self._released:
+            self._released.notify_all()
+
+    def retry_after(self) -> int:
+        """Seconds until usage should be back under the low watermark."""
+        excess = self._usage() - self.low_watermark
+        if excess <= 0:
+            return 1
+        if not self.drain_rate:
+            return 5
+
+        excess_events = excess * self.max_events
+        return max(1, min(60, math.ceil(excess_events / self.drain_rate)))
+
+
+event_queue = AdmissionController(
+    max_events=settings.INGEST_QUEUE_MAX_EVENTS,
+    max_bytes=settings.INGEST_QUEUE_MAX_BYTES,
+    high_watermark=settings.INGEST_QUEUE_HIGH_WATERMARK,
+    low_watermark=settings.INGEST_QUEUE_LOW_WATERMARK,
+)
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import os
+import struct
+import time
+from pathlib import Path
+from app.core.config import settings
+from app.core.kafka import Record, kafka_producer
+
+logger = logging.getLogger(__name__)
+
+# key length, value length
+FRAME_HEADER = struct.Struct("<II")
+SEGMENT_SUFFIX = ".log"
+POSITION_SUFFIX = ".pos"
+
+
+class SpillFullError(Exception):
+    pass
+
+
+class SpillLog:
+    """Append-only, segment-based on-disk buffer for unsent Kafka records.
+
+    Each ``append`` writes one contiguous block and fsyncs once. Segments are
+    rolled at ``segment_bytes``; the drainer replays sealed segments oldest
+    first and remembers its read position in a ``.pos`` sidecar, so a restart
+    resumes where it stopped instead of replaying the whole segment. The
+    active segment is only sealed early once the writer has been idle for
+    ``seal_idle`` seconds or the segment is ``seal_age`` seconds old.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int,
+        max_bytes: int,
+        seal_idle: float,
+        seal_age: float,
+    ):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.seal_idle = seal_idle
+        self.seal_age = seal_age
+
+        self._lock = asyncio.Lock()
+        self._active: Path | None = None
+        self._active_size = 0
+        self._active_since = 0.0
+        self._last_append = 0.0
+        self._next_seq = 0
+        self.total_bytes = 0
+
+    def open(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        segments = self._segments()
+        self.total_bytes = sum(p.stat().st_size for p in segments)
+        if segments:
+            self._next_seq = int(segments[-1].stem) + 1
+
+        if segments:
+            logger.warning(
+                "💾 Spill log has %d segments (%d bytes) pending replay",
+                len(segments),
+                self.total_bytes,
+            )
+
+    def _segments(self) -> list[Path]:
+        return sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def _roll(self):
+        self._active = self.directory / f"{self._next_seq:020d}{SEGMENT_SUFFIX}"
+        self._active_size = 0
+        self._active_since = time.monotonic()
+        self._next_seq += 1
+
+    @staticmethod
+    def _encode(records: list[Record]) -> bytes:
+        parts = []
+        for key, value in records:
+            parts.append(FRAME_HEADER.pack(len(key), len(value)))
+            parts.append(key)
+            parts.append(value)
+        return b"".join(parts)
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        with open(path, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def append(self, records: list[Record]):
+        if not records:
+            return
+
+        data = self._encode(records)
+
+        async with self._lock:
+            if self.total_bytes + len(data) > self.max_bytes:
+                raise SpillFullError(
+                    f"Spill log full ({self.total_bytes} bytes)"
+                )
+
+            if self._active is None or self._active_size >= self.segment_bytes:
+                self._roll()
+
+            await asyncio.to_thread(self._write, self._active, data)
+            self._active_size += len(data)
+            self.total_bytes += len(data)
+            self._last_append = time.monotonic()
+
+        logger.warning("💾 Spilled %d records to %s", len(records), self._active.name)
+
+    @staticmethod
+    def _read(path: Path, position: int, max_records: int) -> tuple[list[Record], int]:
+        records: list[Record] = []
+        with open(path, "rb") as f:
+            f.seek(position)
+            while len(records) < max_records:
+                header = f.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    break
+                key_len, value_len = FRAME_HEADER.unpack(header)
+                body = f.read(key_len + value_len)
+                if len(body) < key_len + value_len:
+                    # Torn write from a crash, nothing valid follows
+                    break
+                records.append((body[:key_len], body[key_len:]))
+            return records, f.tell() if records else position
+
+    async def _next_sealed(self) -> Path | None:
+        async with self._lock:
+            segments = self._segments()
+            if not segments:
+                return None
+
+            if segments[0] == self._active:
+                # Only the active segment is left: seal it once the writer
+                # has moved on, not on every idle drain pass
+                now = time.monotonic()
+                if (
+                    not self._active_size
+                    or now - self._last_append < self.seal_idle
+                    and now - self._active_since < self.seal_age
+                ):
+                    return None
+                self._active = None
+            return segments[0]
+
+    async def _drain_segment(self, path: Path, batch_size: int, rate: int) -> bool:
+        pos_path = path.with_suffix(POSITION_SUFFIX)
+        position = int(pos_path.read_text()) if pos_path.exists() else 0
+
+        while True:
+            records, new_position = await asyncio.to_thread(
+                self._read, path, position, batch_size
+            )
+            if not records:
+                break
+
+            failed = await kafka_producer.send_records(records)
+            if failed:
+                # Resend the whole chunk next time; Kafka is still unhealthy
+                return False
+
+            position = new_position
+            pos_path.write_text(str(position))
+            await asyncio.sleep(len(records) / rate)
+
+        size = path.stat().st_size
+        path.unlink()
+        pos_path.unlink(missing_ok=True)
+        self.total_bytes -= size
+
+        logger.info("✅ Spill segment %s replayed", path.name)
+        return True
+
+    async def drain(self, batch_size: int, rate: int, idle_interval: float = 5.0):
+        """Replay spilled segments into Kafka at no more than ``rate`` events/sec."""
+        while True:
+            try:
+                path = await self._next_sealed()
+                if path is None or not await self._drain_segment(
+                    path, batch_size, rate
+                ):
+                    await asyncio.sleep(idle_interval)
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception:
+                logger.exception("❌ Spill drainer failed")
+                await asyncio.sleep(idle_interval)
+
+
+spill_log = (
+    SpillLog(
+        directory=settings.SPILL_DIR,
+        segment_bytes=settings.SPILL_SEGMENT_BYTES,
+        max_bytes=settings.SPILL_MAX_BYTES,
+        seal_idle=settings.SPILL_SEAL_IDLE_SECONDS,
+        seal_age=settings.SPILL_SEAL_MAX_AGE_SECONDS,
+    )
+    if settings.SPILL_ENABLED
+    else None
+)
@@ -1,21 +1,22 @@
 import logging
 from app.services.queue import event_queue
 from app.core.kafka import kafka_producer
+from app.services.spill import spill_log
 
 logger = logging.getLogger(__name__)
 
 
 async def kafka_worker():
     while True:
-        events = await event_queue.get()
+        batch = await event_queue.get()
 
         try:
-            payload = [e.model_dump(mode="json") for e in events]
-            await kafka_producer.send_batch(payload)
+            failed = await kafka_producer.send_records(batch.records)
+            if failed and spill_log is not None:
+                await spill_log.append(failed)
 
         except Exception:
             logger.exception("❌ Kafka worker failed")
 
         finally:
-            event_queue.task_done()
-
+            event_queue.task_done(batch)